@@ -0,0 +1,205 @@
+import collections
+import json
+import math
+import os
+import time
+
+GOLDEN = (math.sqrt(5) - 1) / 2
+PEAK_DROP = 0.25  # Fraction the metric must fall below the coarse peak before the sweep stops early
+
+
+class SearchStopped(Exception):
+    pass
+
+
+class AutofocusEngine:
+    """Finds the Z position with the highest focus metric.
+
+    A coarse sweep walks the travel in coarse_step increments, starting from the end nearest to the current
+    position, until the metric has fallen PEAK_DROP below a peak twice in a row. The bracket around the best
+    coarse sample is then narrowed by golden-section search down to tolerance steps and finished with a
+    parabolic fit through the best sample and its neighbours.
+
+    move_to(z) must return once the motor has settled, and measure() must return the metric of a frame captured
+    after that. Every measured position costs one move out of budget; positions are never measured twice.
+    """
+
+    def __init__(self, move_to, measure, min_position, max_position, coarse_step=20, budget=24, tolerance=2):
+        self._move_to = move_to
+        self._measure = measure
+        self._min = min_position
+        self._max = max_position
+        self._coarse_step = max(1, coarse_step)
+        self._budget = budget
+        self._tolerance = max(2, tolerance)
+        self._position = None
+        self._samples = {}
+        self._moves = 0
+        self._stopped = False
+
+    def stop(self):
+        self._stopped = True
+
+    def run(self, start, threshold=None, seed=None):
+        """Searches from the current position start. Returns (position, focus) after moving to the best position.
+
+        The search is skipped when the focus at start already reaches threshold. With a seed, a Z known to be
+        close to the peak, the coarse sweep is replaced by a short uphill walk from the seed.
+        """
+        begin = time.monotonic()
+        self._position = start
+        self._samples = {}
+        self._moves = 0
+        self._stopped = False
+        try:
+            focus = self._sample(start)
+            if threshold is None or focus < threshold:
+                low, high = self._sweep(start) if seed is None else self._climb(seed)
+                self._refine(low, high)
+                self._fit_parabola()
+        except SearchStopped:
+            pass
+        best = max(self._samples, key=self._samples.get)
+        if best != self._position and not self._stopped:
+            self._move_to(best)
+            self._position = best
+        print('Autofocus: Best position {0} (focus {1:.1f}) after {2} moves in {3:.1f}s'.format(
+            best, self._samples[best], self._moves, time.monotonic() - begin))
+        return best, self._samples[best]
+
+    def _sample(self, position):
+        if position not in self._samples:
+            if self._stopped or self._moves >= self._budget:
+                raise SearchStopped
+            if position != self._position:
+                self._move_to(position)
+                self._position = position
+                self._moves += 1
+            self._samples[position] = self._measure()
+        return self._samples[position]
+
+    def _sweep(self, start):  # Returns the bracket around the coarse peak
+        positions = list(range(self._min, self._max + 1, self._coarse_step))
+        if positions[-1] != self._max:
+            positions.append(self._max)
+        if self._max - start < start - self._min:
+            positions.reverse()
+        best = None
+        falling = 0
+        for index, position in enumerate(positions):
+            focus = self._sample(position)
+            if best is None or focus > self._samples[positions[best]]:
+                best, falling = index, 0
+            elif focus < (1 - PEAK_DROP) * self._samples[positions[best]]:
+                falling += 1
+                if falling == 2 and best > 0:  # Clearly past a peak, not just noise on a flat curve
+                    break
+            else:
+                falling = 0
+        neighbours = positions[max(0, best - 1)], positions[min(len(positions) - 1, best + 1)]
+        return min(neighbours), max(neighbours)
+
+    def _climb(self, seed):  # Brackets the peak near the seed, walking uphill in steps of a quarter coarse step
+        step = max(self._tolerance, self._coarse_step // 4)
+        position = min(self._max, max(self._min, seed))
+        low, high = max(self._min, position - step), min(self._max, position + step)
+        self._sample(position)
+        while True:
+            if self._sample(low) > self._samples[position]:
+                position, high, low = low, position, max(self._min, low - step)
+            elif self._sample(high) > self._samples[position]:
+                position, low, high = high, position, min(self._max, high + step)
+            else:
+                return low, high
+            if low == position or high == position:  # Peak at the end of the travel
+                return low, high
+
+    def _refine(self, low, high):  # Golden-section search on integer positions, reusing earlier samples
+        while high - low > self._tolerance:
+            inner_low = int(round(high - GOLDEN * (high - low)))
+            inner_high = int(round(low + GOLDEN * (high - low)))
+            if inner_low == inner_high:
+                inner_high += 1
+            if self._sample(inner_low) >= self._sample(inner_high):
+                high = inner_high
+            else:
+                low = inner_low
+
+    def _fit_parabola(self):  # Samples the vertex of the parabola through the best sample and its neighbours
+        positions = sorted(self._samples)
+        best = max(positions, key=self._samples.get)
+        index = positions.index(best)
+        if index == 0 or index == len(positions) - 1:
+            return
+        x0, x1, x2 = positions[index - 1], best, positions[index + 1]
+        y0, y1, y2 = self._samples[x0], self._samples[x1], self._samples[x2]
+        denominator = (x1 - x0) * (y1 - y2) - (x1 - x2) * (y1 - y0)
+        if not denominator:
+            return
+        vertex = x1 - 0.5 * ((x1 - x0) ** 2 * (y1 - y2) - (x1 - x2) ** 2 * (y1 - y0)) / denominator
+        vertex = int(round(vertex))
+        if x0 < vertex < x2:
+            self._sample(vertex)
+
+    @property
+    def moves(self):
+        return self._moves
+
+    @property
+    def stopped(self):  # True when the last run was ended by stop() and only returned the best sample so far
+        return self._stopped
+
+    @property
+    def position(self):
+        return self._position
+
+
+class FocusMap:
+    """Best known Z per lens and stage position, persisted as JSON and bounded by least recent use.
+
+    Entries are keyed by (lens index, left-right servo, forward-backward servo). nearest() returns the Z of the
+    closest stage position stored for the same lens, which autofocus uses as the seed of its search.
+    """
+
+    def __init__(self, path, size=256):
+        self._path = path
+        self._size = size
+        self._entries = collections.OrderedDict()
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self._path):
+            return
+        try:
+            with open(self._path, 'r') as file:
+                entries = json.load(file)
+        except (OSError, ValueError) as e:
+            print('FocusMap: Unable to load {0}: {1}'.format(self._path, e))
+            return
+        for lens, x, y, z in entries:  # Saved from least to most recently used
+            self._entries[(lens, x, y)] = z
+        while len(self._entries) > self._size:
+            self._entries.popitem(last=False)
+
+    def save(self):
+        with open(self._path, 'w') as file:
+            json.dump([list(key) + [z] for key, z in self._entries.items()], file)
+
+    def store(self, lens, x, y, z):
+        key = (lens, x, y)
+        self._entries.pop(key, None)
+        self._entries[key] = z
+        if len(self._entries) > self._size:
+            self._entries.popitem(last=False)
+
+    def nearest(self, lens, x, y):
+        """Returns the Z stored closest to (x, y) for lens, None if the lens has no entry yet."""
+        candidates = [key for key in self._entries if key[0] == lens]
+        if not candidates:
+            return None
+        key = min(candidates, key=lambda candidate: (candidate[1] - x) ** 2 + (candidate[2] - y) ** 2)
+        self._entries.move_to_end(key)
+        return self._entries[key]
+
+    def __len__(self):
+        return len(self._entries)
@@ -1,13 +1,13 @@
-import asyncio
-import base64
+import concurrent.futures
+import contextlib
 import functools
 import imp
-import importlib
 import os
 import queue
 import re
 import socket
 import threading
+import time
 import uuid
 import json
 import webbrowser
@@ -22,15 +22,20 @@ from PyQt5.QtCore import QThread, pyqtSignal, pyqtSlot, QSettings
 from PyQt5.QtGui import QIcon, QPixmap
 from PyQt5.QtWidgets import QMainWindow, QApplication, QSizePolicy, QDialog
 
+import commands
+import hardware
+import scan
 import server
+import zstack
+from autofocus import AutofocusEngine, FocusMap
+from focus import FocusMeter
+from framebus import FrameBus, FrameRing, FrameScheduler
+from motion import MotionHandle, MotionScheduler
+from telemetry import Telemetry
 import automi_ui
 import preferences_ui
 
 
-def check_dependency(dependency):
-    return importlib.find_loader(dependency)
-
-
 def convert(item):
     try:
         print('item -> int')
@@ -52,10 +57,7 @@ def convert(item):
                 print('Unable to convert. Invalid input')
 
 
-if check_dependency('RPi') is not None:
-    from motor import AdaServo, Stepper
-else:
-    print('Import Error: Unable to import AdaServo, Stepper')
+from motor import AdaServo, Stepper
 
 
 class Window(QMainWindow, automi_ui.Ui_MainWindow):
@@ -119,6 +121,7 @@ class Window(QMainWindow, automi_ui.Ui_MainWindow):
 
         QCloseEvent.accept()
         self._save_settings()
+        self.process_executor.shutdown(wait=False)
         self._app_status = False
         print('Threads Closed!')
         self.close()
@@ -146,21 +149,54 @@ class Window(QMainWindow, automi_ui.Ui_MainWindow):
         print('Closing: Settings saved.')
 
     def _setup(self):
-        self.camera = Camera(self._settings['camera']['index'])
+        print('Hardware: Capabilities {}'.format(hardware.CAPABILITIES))
+        # Fusion and pyramids run in a worker process forked here, before any camera, server or motor thread
+        # exists: forking a multi-threaded process with OpenCV loaded can deadlock the child.
+        self.process_executor = concurrent.futures.ProcessPoolExecutor(max_workers=1)
+        self.process_executor.submit(int).result()
+        self.camera = Camera(self._settings['camera']['index'], self._settings['server']['profiles'],
+                             self._settings['camera']['fps'], self._settings['camera']['ring_size'])
         self.camera.start()
 
-        self.video_server = server.VideoServer("", self._video_port)
+        self.video_server = server.VideoServer("", self._video_port, len(self._settings['server']['profiles']))
         self.video_server.start()
 
-        self.camera_thread = CameraThread(self.camera)
+        self.focus_meter = FocusMeter(**self._settings['camera']['focus'])
+        self.camera_thread = CameraThread(self.camera, self.focus_meter)
         self.camera_thread.start()
-        self.video_server_thread = VideoServerThread(self.video_server, self.camera_thread)
+        self.command_queue = commands.CommandQueue()
+        self.video_server_thread = VideoServerThread(self.video_server, self.camera_thread, self.command_queue)
         self.video_server_thread.start()
 
-        self.servomotor_thread = ServoMotorThread()
-        self.servomotor_thread.start()
-        self.autofocus_thread = AutofocusThread()
-        # self.autofocus_thread.start()
+        self.comm_server = server.CommunicationServer("", self._comm_port, self.video_server,
+                                                      self.camera.frame_bus.latency)
+        self.comm_server.start()
+        self.comm_server_thread = CommunicationServerThread(self.comm_server, self.command_queue)
+        self.comm_server_thread.start()
+
+        if self._settings['server']['mjpeg_port']:  # 0 disables the browser stream
+            self.mjpeg_server = server.MjpegServer("", self._settings['server']['mjpeg_port'],
+                                                   len(self._settings['server']['profiles']))
+            self.mjpeg_server.start()
+            self.mjpeg_server_thread = MjpegServerThread(self.mjpeg_server, self.camera_thread)
+            self.mjpeg_server_thread.start()
+
+        self.motion_controller = MotionController({
+            'updown': self._settings['updown_motor']['position'],
+            'lens': self._settings['lens_motor']['position']['dynamic'],
+            'leftright': self._settings['left-right_servo']['position'],
+            'forwardbackward': self._settings['forward-backward_servo']['position'],
+            'brightness': self._settings['brightness_servo']['position'],
+        })
+        self.command_thread = CommandThread(self.command_queue, self._process_sent_command, self._report)
+        self.telemetry = Telemetry([
+            lambda: dict(self.motion_controller.positions),
+            lambda: {'lens_index': self._settings['lens_motor']['index'], 'zoom': self.camera.zoom,
+                     'focus': round(self.focus_meter.value, 1), 'controller': self._controlled_by},
+        ], **self._settings['server']['telemetry'])
+        self.video_server.telemetry = self.telemetry
+        self.comm_server.telemetry = self.telemetry
+        self.command_thread.start()
         try:
             self._ip = (([ip for ip in socket.gethostbyname_ex(socket.gethostname())[2] if
                           not ip.startswith("127.")] or [
@@ -178,34 +214,49 @@ class Window(QMainWindow, automi_ui.Ui_MainWindow):
             else:
                 print('Dir Already exists ' + dir)
 
-        if check_dependency('RPi') is not None:
-            self.updown_motor = Stepper(
-                dir=self._settings['updown_motor']['pins']['dir'],
-                step=self._settings['updown_motor']['pins']['step'],
-                step_angle=self._settings['updown_motor']['pins']['step_angle'],
-                delay=self._settings['updown_motor']['pins']['delay'],
-                resolution=self._settings['updown_motor']['pins']['resolution'],
-                mode_pins=self._settings['updown_motor']['pins']['mode_pins']
-            )  # M0 M1 M2
-            print(self.updown_motor)
-
-            self.lens_motor = Stepper(
-                dir=self._settings['lens_motor']['pins']['dir'],
-                step=self._settings['lens_motor']['pins']['step'],
-                step_angle=self._settings['lens_motor']['pins']['step_angle'],
-                delay=self._settings['lens_motor']['pins']['delay'],
-                resolution=self._settings['lens_motor']['pins']['resolution'],
-                mode_pins=self._settings['lens_motor']['pins']['mode_pins']
-            )
-            print(self.lens_motor)
-
-            # Initialize servo motors
-            self.leftright_servo = AdaServo(0, 50)
-            self.forwardbackward_servo = AdaServo(2, 50)
-            self.brightness_servo = AdaServo(1, 50)
+        self.updown_motor = Stepper(
+            dir=self._settings['updown_motor']['pins']['dir'],
+            step=self._settings['updown_motor']['pins']['step'],
+            step_angle=self._settings['updown_motor']['pins']['step_angle'],
+            delay=self._settings['updown_motor']['pins']['delay'],
+            resolution=self._settings['updown_motor']['pins']['resolution'],
+            mode_pins=self._settings['updown_motor']['pins']['mode_pins']
+        )  # M0 M1 M2
+        print(self.updown_motor)
+
+        self.lens_motor = Stepper(
+            dir=self._settings['lens_motor']['pins']['dir'],
+            step=self._settings['lens_motor']['pins']['step'],
+            step_angle=self._settings['lens_motor']['pins']['step_angle'],
+            delay=self._settings['lens_motor']['pins']['delay'],
+            resolution=self._settings['lens_motor']['pins']['resolution'],
+            mode_pins=self._settings['lens_motor']['pins']['mode_pins']
+        )
+        print(self.lens_motor)
+
+        # Initialize servo motors
+        self.leftright_servo = AdaServo(0, 50)
+        self.forwardbackward_servo = AdaServo(2, 50)
+        self.brightness_servo = AdaServo(1, 50)
+
+        self.focus_map = FocusMap(self._BASE_DIR + self._settings['focus_map']['file'],
+                                  self._settings['focus_map']['size'])
+        self.autofocus_thread = AutofocusThread(self.focus_meter, self.updown_motor, self.motion_controller,
+                                                **self._settings['autofocus'])
+        self.autofocus_thread.start()
+
+        self.zstack_thread = ZStackThread(self.camera, self.process_executor, self.updown_motor,
+                                          self.motion_controller, self._settings['zstack']['settle'])
+        self.zstack_thread.start()
+        self.scan_thread = ScanThread(self.camera, self.process_executor, self.autofocus_thread, self.leftright_servo,
+                                      self.forwardbackward_servo, self.motion_controller,
+                                      self._settings['scan']['settle'])
+        self.scan_thread.start()
 
     def _setup_widgets(self):
         self.frame_label.setScaledContents(True)
+        self.action_zstack = self.menu_menu.addAction('Capture Z-Stack')
+        self.action_scan = self.menu_menu.addAction('Scan Slide')
         self.frame_label.setSizePolicy(QSizePolicy.Ignored, QSizePolicy.Ignored)
         # Set Widget Icons
         self.change_lens_button.setIcon(QIcon(QPixmap(self._BASE_DIR + '{icons_dir}/icon_lens_off.png'
@@ -262,50 +313,69 @@ class Window(QMainWindow, automi_ui.Ui_MainWindow):
 
         # Setup previous position
         self._set_zoom()
-        if check_dependency('RPi') is not None:
-            self.brightness_servo.set_angle(self._settings['brightness_servo']['position'])
-            self.leftright_servo.set_angle(self._settings['left-right_servo']['position'])
-            self.forwardbackward_servo.set_angle(self._settings['forward-backward_servo']['position'])
+        self.brightness_servo.set_angle(self._settings['brightness_servo']['position'])
+        self.leftright_servo.set_angle(self._settings['left-right_servo']['position'])
+        self.forwardbackward_servo.set_angle(self._settings['forward-backward_servo']['position'])
 
     def _setup_thread_signals(self):
         # Connect to thread signals. This functions are automatically called when a signal is emitted from the thread
         self.camera_thread.ready_frame.connect(self._update_frame)
+        self.camera_thread.measured_focus.connect(self._update_focus)
         self.video_server_thread.client_accepted.connect(self._update_client_menu)
         self.video_server_thread.client_disconnected.connect(self._remove_client_menu)
-        self.video_server_thread.received_command.connect(self._process_sent_command)
+        self.video_server_thread.client_disconnected.connect(self.comm_server.close_session)
+        self.command_thread.changed_zoom.connect(self.zoom_slider.setValue)
+        self.command_thread.changed_brightness.connect(self.brightness_slider.setValue)
 
-        self.servomotor_thread.move_leftright.connect(self.finished_leftright)
-        self.servomotor_thread.move_forwardbackward.connect(self.finished_forwardbackward)
-        self.servomotor_thread.move_brightness.connect(self.finished_brightness)
+        self.motion_controller.move_leftright.connect(self.finished_leftright)
+        self.motion_controller.move_forwardbackward.connect(self.finished_forwardbackward)
+        self.motion_controller.move_brightness.connect(self.finished_brightness)
 
-        self.servomotor_thread.started_lens.connect(self.started_lens)
-        self.servomotor_thread.ongoing_lens.connect(self.ongoing_lens)
-        self.servomotor_thread.finished_lens.connect(self.finished_lens)
+        self.motion_controller.started_lens.connect(self.started_lens)
+        self.motion_controller.ongoing_lens.connect(self.ongoing_lens)
+        self.motion_controller.finished_lens.connect(self.finished_lens)
 
-        self.servomotor_thread.started_updown.connect(self.started_updown)
-        self.servomotor_thread.ongoing_updown.connect(self.ongoing_updown)
-        self.servomotor_thread.finished_updown.connect(self.finished_updown)
+        self.motion_controller.started_updown.connect(self.started_updown)
+        self.motion_controller.ongoing_updown.connect(self.ongoing_updown)
+        self.motion_controller.finished_updown.connect(self.finished_updown)
 
         self.autofocus_thread.started.connect(self.started_autofocus)
         self.autofocus_thread.ongoing.connect(self.ongoing_autofocus)
         self.autofocus_thread.finished.connect(self.finished_autofocus)
 
+        self.zstack_thread.started.connect(self.started_autofocus)  # Same controls locked as for autofocus
+        self.zstack_thread.ongoing.connect(self.ongoing_autofocus)
+        self.zstack_thread.finished.connect(self.finished_zstack)
+        self.zstack_thread.saved.connect(lambda directory: self.statusbar.showMessage(
+            "Saved Z-Stack: {}".format(directory)))
+        self.zstack_thread.fused.connect(lambda path: self.statusbar.showMessage("Saved Fused Image: {}".format(path)))
+
+        self.scan_thread.started.connect(self.started_autofocus)
+        self.scan_thread.ongoing.connect(lambda done, total: self.statusbar.showMessage(
+            "Scanning: Tile {0}/{1}".format(done, total)))
+        self.scan_thread.finished.connect(self.finished_scan)
+        self.scan_thread.saved.connect(lambda directory: self.statusbar.showMessage(
+            "Saved Mosaic: {}".format(directory)))
+
 
     def _setup_widget_signals(self):
         # Connect Menu Actions
         self.action_preferences.triggered.connect(lambda: self._menu_preference())
-        # (self.current_position, self.focus, self.threshold, self.max_position, self.min_position)
+        # (self.current_position, self.focus, self.threshold, self.max_position, self.min_position, seed)
         self.action_autofocus.triggered.connect(
             lambda: self.autofocus_thread.add_command((
                 self._settings['updown_motor']['position'],
                 self._focus,
                 self._settings['camera']['blur']['threshold'],
                 self._settings['updown_motor']['max_position'],
-                self._settings['updown_motor']['min_position']
-
+                self._settings['updown_motor']['min_position'],
+                self.focus_map.nearest(*self._stage_key())
             ))
         )
 
+        self.action_zstack.triggered.connect(self._capture_zstack)
+        self.action_scan.triggered.connect(self._scan_slide)
+
         # Connect control signals
         self.camera_icon.clicked.connect(self._capture_image)
         self.video_icon.clicked.connect(self._record_video)
@@ -322,7 +392,7 @@ class Window(QMainWindow, automi_ui.Ui_MainWindow):
         # Clicked Event
         # (widget, command, servo, current_position, step)
         self.left_button.clicked.connect(
-            lambda: self.servomotor_thread.start_lrfb({
+            lambda: self.motion_controller.start_lrfb({
                 'widget': 'button',
                 'command': 'left',
                 'servo': self.leftright_servo,
@@ -331,7 +401,7 @@ class Window(QMainWindow, automi_ui.Ui_MainWindow):
             })
         )
         self.right_button.clicked.connect(
-            lambda: self.servomotor_thread.start_lrfb({
+            lambda: self.motion_controller.start_lrfb({
                 'widget': 'button',
                 'command': 'right',
                 'servo': self.leftright_servo,
@@ -340,7 +410,7 @@ class Window(QMainWindow, automi_ui.Ui_MainWindow):
             })
         )
         self.forward_button.clicked.connect(
-            lambda: self.servomotor_thread.start_lrfb({
+            lambda: self.motion_controller.start_lrfb({
                 'widget': 'button',
                 'command': 'forward',
                 'servo': self.forwardbackward_servo,
@@ -349,7 +419,7 @@ class Window(QMainWindow, automi_ui.Ui_MainWindow):
             })
         )
         self.backward_button.clicked.connect(
-            lambda: self.servomotor_thread.start_lrfb({
+            lambda: self.motion_controller.start_lrfb({
                 'widget': 'button',
                 'command': 'backward',
                 'servo': self.forwardbackward_servo,
@@ -359,7 +429,7 @@ class Window(QMainWindow, automi_ui.Ui_MainWindow):
         )
         # (motor, lens_index, current_position, p1, p2, p3)
         self.change_lens_button.clicked.connect(
-            lambda: self.servomotor_thread.start_lens({
+            lambda: self.motion_controller.start_lens({
                 'motor': self.lens_motor,
                 'lens_index': self._settings['lens_motor']['index'],
                 'current_position': self._settings['lens_motor']['position']['dynamic'],
@@ -374,7 +444,7 @@ class Window(QMainWindow, automi_ui.Ui_MainWindow):
 
         # Released Event
         self.updown_slider.sliderReleased.connect(
-            lambda: self.servomotor_thread.start_updown({
+            lambda: self.motion_controller.start_updown({
                 'motor': self.updown_motor,
                 'new_position': self.updown_slider.value(),
                 'current_position': self._settings['updown_motor']['position'],
@@ -384,7 +454,7 @@ class Window(QMainWindow, automi_ui.Ui_MainWindow):
         )
         # widget, command, servo, current_position,
         self.brightness_slider.sliderReleased.connect(
-            lambda: self.servomotor_thread.start_lrfb({
+            lambda: self.motion_controller.start_lrfb({
                 'widget': 'slider',
                 'command': 'brightness',
                 'servo': self.brightness_servo,
@@ -467,6 +537,7 @@ class Window(QMainWindow, automi_ui.Ui_MainWindow):
             print('Please connect to a network.')
 
         self.video_server.reset((self._ip, self._video_port))
+        self.comm_server.reset((self._ip, self._comm_port))
 
     def _shutdown_computer(self):
         self.close()
@@ -474,20 +545,19 @@ class Window(QMainWindow, automi_ui.Ui_MainWindow):
 
     def _update_client_menu(self):
         self.connected_devices_menu.clear()
-        for client in self.video_server.clients:
-            name = self.video_server.clients[client]['name']
+        for client in self.video_server.clients.values():
+            name = client['name']
             self._client_names.append(name)
             self._clients_dic[name] = lambda: self._grant_control(name)
             menu = self.connected_devices_menu.addMenu(name)
             menu.addAction('Grant Control', functools.partial(self._grant_control, name))
             menu.addAction('Remove Control').triggered.connect(self._remove_control)
 
-    def _remove_client_menu(self):
-        conn = self.video_server_thread.client_to_remove
-        if self._controlled_by == self.video_server.clients[conn]['name']:
+    @pyqtSlot(str)
+    def _remove_client_menu(self, name):
+        if self._controlled_by == name:
             del self._clients_dic[self._controlled_by]
             self._controlled_by = ""
-        self.video_server.clients = conn
         self._update_client_menu()
 
     def _grant_control(self, client_name):
@@ -497,88 +567,53 @@ class Window(QMainWindow, automi_ui.Ui_MainWindow):
     def _remove_control(self):
         self._controlled_by = ''
 
-    def _process_sent_command(self):
-        name = self.video_server_thread.command['name']
-        command = self.video_server_thread.command['command']
-
-        if self._controlled_by == name:
-            command = command.split(":")
-            command_type = command[0]
-
-            if command_type == 'zoom':
-                command_value = int(command[1])
-                self.camera.zoom = command_value
-                self.zoom_slider.setValue(command_value)
-            elif command_type == 'brightness':
-                command_value = int(command[1])
-                self.servomotor_thread.start_lrfb({
-                    'widget': 'slider',
-                    'command': 'brightness',
-                    'servo': self.brightness_servo,
-                    'current_position': self.brightness_slider.value(),
-                    'step': 0
-                })
-                self.brightness_slider.setValue(command_value)
-            elif command_type == 'forward':
-                self.servomotor_thread.start_lrfb({
-                    'widget': 'button',
-                    'command': 'forward',
-                    'servo': self.forward_button,
-                    'current_position': self._settings['forward-backward_servo']['position'],
-                    'step': self._settings['forward-backward_servo']['steps']
-                })
-            elif command_type == 'backward':
-                self.servomotor_thread.start_lrfb({
-                    'widget': 'button',
-                    'command': 'backward',
-                    'servo': self.forward_button,
-                    'current_position': self._settings['forward-backward_servo']['position'],
-                    'step': self._settings['forward-backward_servo']['steps']
-                })
-            elif command_type == 'left':
-                self.servomotor_thread.start_lrfb({
-                    'widget': 'button',
-                    'command': 'left',
-                    'servo': self.forward_button,
-                    'current_position': self._settings['left-right_servo']['position'],
-                    'step': self._settings['left-right_servo']['steps']
-                })
-            elif command_type == 'right':
-                self.servomotor_thread.start_lrfb({
-                    'widget': 'button',
-                    'command': 'right',
-                    'servo': self.forward_button,
-                    'current_position': self._settings['left-right_servo']['position'],
-                    'step': self._settings['left-right_servo']['steps']
-                })
-            elif command_type == 'up':
-                # if self._settings['updown_motor']['position'] < self._settings['updown_motor']['max_position']:
-                #     self._settings['updown_motor']['position'] += 1
-                #     self.updown_slider.setValue(self._settings['updown_motor']['position'])
-                #     self.updown_motor.rotate('ccw')
-                self.servomotor_thread.start_updown({
-                    'motor': self.updown_motor,
-                    'new_position': self._settings['updown_motor']['position'] + 1,
-                    'current_position': self._settings['updown_motor']['position'],
-                    'max_position': self._settings['updown_motor']['max_position'],
-                    'min_position': self._settings['updown_motor']['min_position']
-                })
-            elif command_type == 'down':
-                # if self._settings['updown_motor']['position'] > self._settings['updown_motor']['min_position']:
-                #     self._settings['updown_motor']['position'] -= 1
-                #     self.updown_slider.setValue(self._settings['updown_motor']['position'])
-                #     self.updown_motor.rotate('cw')
-                self.servomotor_thread.start_updown({
-                    'motor': self.updown_motor,
-                    'new_position': self._settings['updown_motor']['position'] - 1,
-                    'current_position': self._settings['updown_motor']['position'],
-                    'max_position': self._settings['updown_motor']['max_position'],
-                    'min_position': self._settings['updown_motor']['min_position']
-                })
-            else:
-                print('Command{cmd} is not yet available'.format(cmd=command_type))
+    def _report(self, name, message):  # Replies use the control channel of a client when it opened one
+        channel = self.comm_server if self.comm_server.has_client(name) else self.video_server
+        channel.post(name, message)
+
+    def _process_sent_command(self, name, command, value):
+        """Runs one coalesced command on the command thread. Returns the MotionHandle of a move, else the value set.
+
+        Raises commands.CommandRejected when the client is not in control or the command is unknown.
+        """
+        if self._controlled_by != name:
+            raise commands.CommandRejected("User:{name} is not permitted to control device.".format(name=name))
+        if command in commands.SETTINGS:
+            if value is None:
+                raise commands.CommandRejected('Command {cmd} needs a value'.format(cmd=command))
+            limits = self._settings['zoom_slider' if command == 'zoom' else 'brightness_servo']
+            value = min(max(value, limits['min_position']), limits['max_position'])
+        if command == 'zoom':
+            self.camera.zoom = value
+            self.command_thread.changed_zoom.emit(value)
+            return value
+        elif command == 'brightness':
+            self.command_thread.changed_brightness.emit(value)
+            return self.motion_controller.start_lrfb({
+                'widget': 'slider',
+                'command': 'brightness',
+                'servo': self.brightness_servo,
+                'current_position': value,
+                'step': 0
+            })
+        elif command == 'updown':  # value is the net number of steps, positive goes up
+            return self.motion_controller.start_updown({
+                'motor': self.updown_motor,
+                'steps': value,
+                'max_position': self._settings['updown_motor']['max_position'],
+                'min_position': self._settings['updown_motor']['min_position']
+            })
+        elif command in ('leftright', 'forwardbackward'):
+            setting = 'left-right_servo' if command == 'leftright' else 'forward-backward_servo'
+            return self.motion_controller.start_lrfb({
+                'widget': 'button',
+                'command': ('left', 'right', 'forward', 'backward')[(value < 0) + 2 * (command == 'forwardbackward')],
+                'servo': self.leftright_servo if command == 'leftright' else self.forwardbackward_servo,
+                'step': abs(value) * self._settings[setting]['steps']
+            })
         else:
-            print("User:{name} is not permitted to control device.".format(name=name))
+            raise commands.CommandRejected('Command {cmd} is not yet available'.format(cmd=command))
+        return None
 
     # def _move_stage(self, direction, action):
     #     setting_name = {
@@ -803,34 +838,84 @@ class Window(QMainWindow, automi_ui.Ui_MainWindow):
                                                .format(icons_dir=self._settings['directories']['icons'])
                                                )))
 
+    def _capture_zstack(self):
+        directory = '{dir}zstack_{id}'.format(dir=self._BASE_DIR + self._IMAGES_DIR, id=uuid.uuid4().hex)
+        self.zstack_thread.add_command((
+            directory,
+            self._settings['updown_motor']['position'],
+            self._settings['zstack']['planes'],
+            self._settings['zstack']['step'],
+            self._settings['updown_motor']['max_position'],
+            self._settings['updown_motor']['min_position'],
+            self._settings['zstack']['fuse']
+        ))
+
+    def _scan_slide(self):
+        x = self._settings['left-right_servo']['position']
+        y = self._settings['forward-backward_servo']['position']
+        try:  # Checked here as well, so an impossible scan never takes the stage
+            scan.grid_positions(x, y, self._settings['scan']['columns'], self._settings['scan']['rows'],
+                                self._settings['scan']['step'])
+        except ValueError as e:
+            self.statusbar.showMessage("Scan: {}".format(e))
+            return
+        focus = None
+        if self._settings['scan']['autofocus']:
+            focus = (self._settings['updown_motor']['position'], self._settings['updown_motor']['max_position'],
+                     self._settings['updown_motor']['min_position'])
+        self.scan_thread.add_command((
+            '{dir}scan_{id}'.format(dir=self._BASE_DIR + self._IMAGES_DIR, id=uuid.uuid4().hex),
+            x,
+            y,
+            self._settings['scan']['columns'],
+            self._settings['scan']['rows'],
+            self._settings['scan']['step'],
+            self._settings['scan']['stride'],
+            focus
+        ))
+
     def _update_frame(self):
         frame = self.camera_thread.image_raw
-        # self._focus = cv2.Laplacian(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), cv2.CV_64F).var()
-        font = cv2.FONT_HERSHEY_SIMPLEX
-        font_size = 0.8
-        thickness = 1
-        color = (255, 255, 255)
-
-        if self.camera.zoom == 0:
-            location = (4, 20)
-            text = "Connection: {ip}:{port_1}".format(ip=self._ip, port_1=self._video_port)
-            cv2.putText(frame, text, location, font, font_size, color, thickness, cv2.LINE_AA)
-            location = (4, 45)
-            text = "Controller: {control}".format(control=self._controlled_by)
-            cv2.putText(frame, text, location, font, font_size, color, thickness, cv2.LINE_AA)
-            # location = (4, 70)
-            # text = "Blurred: {}".format(self._focus) if (
-            #             self._focus < self._settings['camera']['blur']['threshold']) else "Not Blurred: {}".format(self._focus)
-            # cv2.putText(frame, text, location, font, font_size, color, thickness, cv2.LINE_AA)
         try:
             height, width, channel = frame.shape
             bytes_per_line = 3 * width
             frame = QtGui.QImage(frame.data, width, height, bytes_per_line,
                                  QtGui.QImage.Format_RGB888).rgbSwapped()  # Working
             pixmap = QtGui.QPixmap(frame)
-            self.frame_label.setPixmap(pixmap)
         except:
             print("Main: No Frame to convert")
+            return
+        start = time.monotonic()
+        self._draw_overlay(pixmap)
+        self.camera.frame_bus.latency.record('overlay_ui', time.monotonic() - start)
+        self.frame_label.setPixmap(pixmap)
+
+    def _draw_overlay(self, pixmap):
+        """Writes the status text on the pixmap shown in the window only.
+
+        Frames in the ring, the stream, captures and recordings stay clean. Remote clients get the same values
+        from the telemetry stream.
+        """
+        lines = []
+        if self.camera.zoom == 0:
+            lines.append((20, "Connection: {ip}:{port_1}/{port_2}".format(ip=self._ip, port_1=self._video_port,
+                                                                         port_2=self._comm_port)))
+            lines.append((45, "Controller: {control}".format(control=self._controlled_by)))
+        lines.append((70, "Blurred: {}".format(self._focus) if self._focus < 100 else
+                      "Not Blurred: {}".format(self._focus)))
+        painter = QtGui.QPainter(pixmap)
+        painter.setRenderHint(QtGui.QPainter.TextAntialiasing)
+        painter.setPen(QtGui.QColor(255, 255, 255))
+        font = painter.font()
+        font.setPixelSize(18)
+        painter.setFont(font)
+        for baseline, text in lines:
+            painter.drawText(4, baseline, text)
+        painter.end()
+
+    @pyqtSlot(float)
+    def _update_focus(self, focus):
+        self._focus = focus
 
     def _auto_focus(self):
         current_position = self._settings['updown_motor']['position']
@@ -852,7 +937,7 @@ class Window(QMainWindow, automi_ui.Ui_MainWindow):
             # Go down first then up until image is not blurred
             # if not topped and self._app_status and current_position < max_position and not current_position == max_position:  # Direction: Up
             #     current_position += 1
-            #     if check_dependency('RPi') is not None:
+            #     if hardware.has('gpio'):
             #         self.updown_motor.rotate('ccw')
             #     sleep(0.5)
             #     self._settings['updown_motor']['position'] = current_position
@@ -860,7 +945,7 @@ class Window(QMainWindow, automi_ui.Ui_MainWindow):
             #         topped = True
             # elif not bottomed and self._app_status and current_position > min_position and not current_position == min_position:  # Direction: Down
             #     current_position -= 1
-            #     if check_dependency('RPi') is not None:
+            #     if hardware.has('gpio'):
             #         self.updown_motor.rotate('cw')
             #     sleep(0.5)
             #     self._settings['updown_motor']['position'] = current_position
@@ -885,7 +970,7 @@ class Window(QMainWindow, automi_ui.Ui_MainWindow):
     @pyqtSlot()
     def started_lens(self):
         self.change_lens_button.clicked.disconnect()
-        self.change_lens_button.clicked.connect(lambda: self.servomotor_thread.stop_lens())
+        self.change_lens_button.clicked.connect(lambda: self.motion_controller.stop_lens())
         self.change_lens_button.setIcon(QIcon(QPixmap(self._BASE_DIR + '{icons_dir}/icon_lens_on.png'
                                                       .format(icons_dir=self._settings['directories']['icons'])
                                                       )))
@@ -901,7 +986,7 @@ class Window(QMainWindow, automi_ui.Ui_MainWindow):
     def finished_lens(self, index, position):
         self.change_lens_button.clicked.disconnect()
         self.change_lens_button.clicked.connect(
-            lambda: self.servomotor_thread.start_lens({
+            lambda: self.motion_controller.start_lens({
                 'motor': self.lens_motor,
                 'lens_index': self._settings['lens_motor']['index'],
                 'current_position': self._settings['lens_motor']['position']['dynamic'],
@@ -924,7 +1009,7 @@ class Window(QMainWindow, automi_ui.Ui_MainWindow):
         print('started_updown_process: Updown movement started.')
         self.updown_slider.setStyleSheet('background: rgb(204, 0, 14);')
         self.updown_slider.sliderReleased.disconnect()
-        self.updown_slider.sliderPressed.connect(lambda: self.servomotor_thread.stop_updown())
+        self.updown_slider.sliderPressed.connect(lambda: self.motion_controller.stop_updown())
         self.left_button.setDisabled(True)
         self.right_button.setDisabled(True)
         self.forward_button.setDisabled(True)
@@ -940,10 +1025,10 @@ class Window(QMainWindow, automi_ui.Ui_MainWindow):
     def finished_updown(self, position):
         self._settings['updown_motor']['position'] = position
         # print(f'Saving last position(updown): {position}')
-        self.updown_slider.sliderPressed.connect(lambda: self.servomotor_thread.stop_updown())
+        self.updown_slider.sliderPressed.connect(lambda: self.motion_controller.stop_updown())
         self.updown_slider.sliderPressed.disconnect()
         self.updown_slider.sliderReleased.connect(
-            lambda: self.servomotor_thread.start_updown({
+            lambda: self.motion_controller.start_updown({
                 'motor': self.updown_motor,
                 'new_position': self.updown_slider.value(),
                 'current_position': self._settings['updown_motor']['position'],
@@ -957,23 +1042,45 @@ class Window(QMainWindow, automi_ui.Ui_MainWindow):
 
     @pyqtSlot()
     def started_autofocus(self):
-        # print('started_updown_process: Updown movement started.')
-        self.updown_slider.sliderReleased.disconnect()
-        self.updown_slider.sliderPressed.connect(lambda: self.updown_worker.stop_command())
+        self.action_autofocus.setDisabled(True)
+        self.disable_control_widgets(('left', 'right', 'forward', 'backward', 'brightness', 'lens', 'updown'))
 
     @pyqtSlot(int)
     def ongoing_autofocus(self, position):
         # print(f'Updown -> Current Position: {position}')
         self._settings['updown_motor']['position'] = position
-        self.autofocus_thread.update_focus(self._focus)
-        self.updown_slider.setDisabled(True)
+        self.motion_controller.positions['updown'] = position
+        self.updown_slider.setValue(position)
 
-    @pyqtSlot(int)
-    def finished_autofocus(self, position):
+    @pyqtSlot(int, bool)
+    def finished_autofocus(self, position, completed):
         self._settings['updown_motor']['position'] = position
-        self.updown_slider.setDisabled(False)
+        self.motion_controller.positions['updown'] = position
+        if completed:  # A stopped or blind search would seed every later one here with a wrong Z
+            self.focus_map.store(*self._stage_key(), position)
+            self.focus_map.save()
+        self.updown_slider.setValue(position)
+        self.action_autofocus.setDisabled(False)
+        self.disable_control_widgets(('left', 'right', 'forward', 'backward', 'brightness', 'lens', 'updown'), False)
         # print(f'Saving last position(updown): {position}')
 
+    @pyqtSlot(int)
+    def finished_zstack(self, position):
+        self._settings['updown_motor']['position'] = position
+        self.motion_controller.positions['updown'] = position
+        self.updown_slider.setValue(position)
+        self.action_autofocus.setDisabled(False)
+        self.disable_control_widgets(('left', 'right', 'forward', 'backward', 'brightness', 'lens', 'updown'), False)
+
+    @pyqtSlot()
+    def finished_scan(self):
+        self.action_autofocus.setDisabled(False)
+        self.disable_control_widgets(('left', 'right', 'forward', 'backward', 'brightness', 'lens', 'updown'), False)
+
+    def _stage_key(self):  # (lens index, left-right, forward-backward) the focus map is keyed by
+        return (self._settings['lens_motor']['index'], self._settings['left-right_servo']['position'],
+                self._settings['forward-backward_servo']['position'])
+
     @pyqtSlot(object)
     def change_settings(self, settings):
         self._settings = settings
@@ -993,98 +1100,246 @@ class Window(QMainWindow, automi_ui.Ui_MainWindow):
         for widget in to_disable:
             widgets[widget].setDisabled(disabled)
 
+def hold_axes(motion, *axes):  # Keeps scheduled moves off the axes, nothing to hold without a controller
+    return motion.hold(*axes) if motion is not None else contextlib.ExitStack()
+
+
 class AutofocusThread(QThread):
     started = pyqtSignal()
     ongoing = pyqtSignal(int)
-    finished = pyqtSignal(int)
+    finished = pyqtSignal(int, bool)  # Position, and whether the search completed
 
-    def __init__(self):
+    def __init__(self, focus_meter, updown_motor=None, motion=None, settle=0.1, timeout=1, **search):
         QtCore.QThread.__init__(self)
         self.commands_queue = queue.Queue(1)
-        self.current_position = 0
-        self.focus = 0
-        self.threshold = 0
-        self.max_position = 0
-        self.min_position = 0
+        self.updown_motor = updown_motor
+        self._motion = motion
+        self._focus_meter = focus_meter
+        self._settle = settle  # Seconds the stage is left to stop vibrating before a frame counts
+        self._timeout = timeout
+        self._search = search  # coarse_step, budget and tolerance of the AutofocusEngine
+        self._engine = None
+        self._position = 0
+        self._settled_at = 0
+        self._completed = False
+
+    def __del__(self):
+        self.wait()
+        print("Closing Autofocus Thread.")
 
-        self.moving = True
-        self.running = True
+    def add_command(self, cmd):
+        try:
+            self.commands_queue.put_nowait(cmd)
+        except queue.Full:
+            print('Autofocus: Already focusing.')
 
-        self.topped = False
-        self.bottomed = False
-        self.cycle = False
+    def stop_command(self):
+        if self._engine:
+            self._engine.stop()
 
-        self.focus_prev = 0
-        self.focus_diff = 0
+    def run(self):
+        while True:
+            print('Autofocus waiting for command...')
+            current_position, focus, threshold, max_position, min_position, seed = self.commands_queue.get()
+            self.started.emit()
+            with hold_axes(self._motion, 'updown'):
+                position, focus = self.focus(current_position, threshold, max_position, min_position, seed)
+            self.finished.emit(position, self._completed)
+
+    def focus(self, current_position, threshold, max_position, min_position, seed=None):
+        """Runs one search in the calling thread. Returns (position, focus). The caller holds the updown axis.
+
+        completed then tells whether the search ran to its end, or was skipped above threshold, with a fresh frame
+        for every measurement.
+        """
+        self._position = current_position
+        self._settled_at = 0  # The frame currently on screen was taken at this position
+        self._completed = True
+        self._engine = AutofocusEngine(self._move_to, self._measure, min_position, max_position, **self._search)
+        try:
+            result = self._engine.run(current_position, threshold, seed)
+            self._completed = self._completed and not self._engine.stopped
+            return result
+        finally:
+            self._engine = None
+
+    def _move_to(self, position):  # Blocks until the stage reached position and settled
+        steps = position - self._position
+        if self.updown_motor is not None:  # Same unit as the slider and MotionController, a quarter turn
+            self.updown_motor.move_positions('ccw' if steps > 0 else 'cw', abs(steps)).wait()
+        self._position = position
+        sleep(self._settle)
+        self._settled_at = time.time()
+        self.ongoing.emit(position)
+
+    def _measure(self):  # Focus of the first frame captured after the last move settled
+        reading = self._focus_meter.wait_for(self._settled_at, self._timeout)
+        if reading is None:
+            print('Autofocus: No fresh frame, using the last focus value.')
+            self._completed = False
+            return self._focus_meter.value
+        return reading[0]
+
+
+class ZStackThread(QThread):
+    started = pyqtSignal()
+    ongoing = pyqtSignal(int)
+    finished = pyqtSignal(int)
+    saved = pyqtSignal(str)
+    fused = pyqtSignal(str)
 
-        self.direction = ''
+    def __init__(self, camera, executor, updown_motor=None, motion=None, settle=0.1):
+        QtCore.QThread.__init__(self)
+        self.commands_queue = queue.Queue(1)
+        self.updown_motor = updown_motor
+        self._motion = motion
+        self._camera = camera
+        self._executor = executor  # Fusion runs in another process, the stream and the UI keep going
+        self._settle = settle
+        self._position = 0
 
     def __del__(self):
         self.wait()
-        print("Closing Lens Thread.")
+        print("Closing Z-Stack Thread.")
 
     def add_command(self, cmd):
-        print('Adding command')
-        self.commands_queue.put(cmd)
-        self.moving = True
+        try:
+            self.commands_queue.put_nowait(cmd)
+        except queue.Full:
+            print('Z-Stack: Already capturing.')
 
-    def stop_command(self):
-        self.moving = False
+    def run(self):
+        while True:
+            directory, current_position, planes, step, max_position, min_position, fuse = self.commands_queue.get()
+            self._position = current_position
+            positions = zstack.plane_positions(current_position, planes, step, min_position, max_position)
+            self.started.emit()
+            with hold_axes(self._motion, 'updown'):
+                try:
+                    frames = zstack.capture_stack(positions, self._move_to, self._grab)
+                except IOError as e:
+                    print('Z-Stack: {}'.format(e))
+                    frames = None
+                self._move_to(current_position)
+            if frames is not None:
+                self._save(directory, positions, frames, fuse)
+            self.finished.emit(current_position)
+
+    def _save(self, directory, positions, frames, fuse):  # The stage is free again while the planes are written
+        try:
+            paths = zstack.write_stack(directory, positions, frames)
+        except IOError as e:
+            print('Z-Stack: {}'.format(e))
+            return
+        self.saved.emit(directory)
+        if fuse:
+            future = self._executor.submit(zstack.fuse_files, paths, os.path.join(directory, 'fused.png'))
+            future.add_done_callback(self._fusion_done)
+
+    def _move_to(self, position):  # Returns the time the stage settled at position
+        steps = position - self._position
+        if self.updown_motor is not None:  # Same unit as the slider and MotionController, a quarter turn
+            self.updown_motor.move_positions('ccw' if steps > 0 else 'cw', abs(steps)).wait()
+        self._position = position
+        sleep(self._settle)
+        self.ongoing.emit(position)
+        return time.time()
+
+    def _grab(self, after):
+        return self._camera.grab(after)
+
+    def _fusion_done(self, future):
+        try:
+            self.fused.emit(future.result())
+        except Exception as e:
+            print('Z-Stack: Fusion failed: {}'.format(e))
+
+
+class ScanThread(QThread):
+    started = pyqtSignal()
+    ongoing = pyqtSignal(int, int)
+    finished = pyqtSignal()
+    saved = pyqtSignal(str)
+
+    def __init__(self, camera, executor, autofocus_thread, leftright_servo=None, forwardbackward_servo=None,
+                 motion=None, settle=0.1):
+        QtCore.QThread.__init__(self)
+        self._motion = motion
+        self.commands_queue = queue.Queue(1)
+        self.leftright_servo = leftright_servo
+        self.forwardbackward_servo = forwardbackward_servo
+        self._camera = camera
+        self._executor = executor  # Builds the tile pyramid once the scan is done
+        self._autofocus_thread = autofocus_thread
+        self._settle = settle
 
-    def update_focus(self, focus):
-        self.focus = focus
+    def __del__(self):
+        self.wait()
+        print("Closing Scan Thread.")
+
+    def add_command(self, cmd):
+        try:
+            self.commands_queue.put_nowait(cmd)
+        except queue.Full:
+            print('Scan: Already scanning.')
 
     def run(self):
-        print('Auto focusing')
         while True:
-            print('Autofocus waiting for command...')
-            (self.current_position, self.focus, self.threshold, self.max_position, self.min_position) = self.commands_queue.get()
-
-            self.focus_prev = self.focus
-            self.topped = False
-            self.bottomed = False
-
-            while self.focus < self.threshold:
-                sleep(0.01)
-                self.ongoing.emit(self.current_position)
-                self.focus_diff = self.focus_prev - self.focus
-                # print(f'Current Focus: {self.focus} - Previous Focus: {self.focus_prev}')
-                # print(f'Focus Difference: {self.focus_diff}')
-                if self.focus_diff > 10:
-                    self.direction = 'up'
-                elif self.focus_diff < -10:
-                    self.direction = 'down'
-
-                # Go down first then up until image is not blurred
-                if not self.topped and self.moving and self.current_position < self.max_position:  # Direction: Up
-                    self.current_position += 10
-
-                    if check_dependency('RPi') is not None:
-                        self.updown_motor.steps_rotate('ccw', 10)
-                        self.ongoing.emit(self.current_position)
-                    else:
-                        sleep(0.5)
-                        self.ongoing.emit(self.current_position)
-                        print('Up')
-
-                    if self.current_position >= self.max_position:
-                        self.topped = True
-                elif not self.bottomed and self.moving and self.current_position > self.min_position:  # Direction: Down
-                    self.current_position -= 10
-
-                    if check_dependency('RPi') is not None:
-                        self.updown_motor.steps_rotate('cw', 10)
-                        self.ongoing.emit(self.current_position)
-                    else:
-                        sleep(0.5)
-                        self.ongoing.emit(self.current_position)
-                        print('Down')
-
-                    if self.current_position <= self.min_position:
-                        self.bottomed = True
-
-
-class ServoMotorThread(QThread):
+            directory, x, y, columns, rows, step, stride, autofocus = self.commands_queue.get()
+            try:
+                positions = scan.grid_positions(x, y, columns, rows, step)
+            except ValueError as e:
+                print('Scan: {}'.format(e))
+                continue
+            self.started.emit()
+            os.makedirs(directory, exist_ok=True)
+            with hold_axes(self._motion, 'updown', 'leftright', 'forwardbackward'):
+                mosaic = None
+                for index, (column, row, tile_x, tile_y) in enumerate(positions):
+                    self._move_to(tile_x, tile_y)
+                    if autofocus:  # (current_position, max_position, min_position), each tile seeds the next one
+                        current_position, max_position, min_position = autofocus
+                        seed = current_position if index else None
+                        position, focus = self._autofocus_thread.focus(current_position, None, max_position,
+                                                                       min_position, seed)
+                        autofocus = (position, max_position, min_position)
+                    frame = self._camera.grab(time.time())
+                    if frame is None:
+                        print('Scan: No frame captured at {0}, {1}'.format(tile_x, tile_y))
+                        continue
+                    if mosaic is None:
+                        mosaic = scan.Mosaic(os.path.join(directory, 'mosaic.npy'), columns, rows, frame.shape,
+                                             stride)
+                    mosaic.add(column, row, frame)
+                    self.ongoing.emit(index + 1, len(positions))
+                self._move_to(x, y)
+            if mosaic is not None:
+                mosaic.close()
+                future = self._executor.submit(scan.build_pyramid, mosaic.path, os.path.join(directory, 'tiles'))
+                future.add_done_callback(lambda future, directory=directory: self._pyramid_done(future, directory))
+            self.finished.emit()
+
+    def _move_to(self, x, y):
+        if self.leftright_servo is not None:
+            self.leftright_servo.set_angle(x)
+            self.forwardbackward_servo.set_angle(y)
+        sleep(self._settle)
+
+    def _pyramid_done(self, future, directory):
+        try:
+            future.result()
+            self.saved.emit(directory)
+        except Exception as e:
+            print('Scan: Building the tile pyramid failed: {}'.format(e))
+
+
+class MotionController(QtCore.QObject):
+    """Moves the stage through a MotionScheduler, one worker per axis, and reports progress with signals.
+
+    start_* return the job's MotionHandle at once. Jobs of one axis run in order, the left-right,
+    forward-backward and brightness servos move in parallel with the steppers, and the lens never changes
+    while the stage moves up or down.
+    """
     move_leftright = pyqtSignal(int)
     move_forwardbackward = pyqtSignal(int)
     move_brightness = pyqtSignal(int)
@@ -1095,239 +1350,134 @@ class ServoMotorThread(QThread):
     ongoing_lens = pyqtSignal(int, int)
     finished_lens = pyqtSignal(int, int)
 
-    def __init__(self):
-        QtCore.QThread.__init__(self)
-        self.commands_queue = queue.Queue(1)
-        self.running_main = True
-        self.running_updown = False
-        self.running_lens = False
-        self.running_lrfb = False
-        self.ongoing_process = False
-
-        self.updown_motor = {
-            'motor': object, 'new_position': 0, 'current_position': 0,
-            'max_position': 0, 'min_position': 0,
-        }
-        self.lens_motor = {
-            'motor': object, 'lens_index': 0, 'current_position': 0,
-            'p1': 0, 'p2': 0, 'p3': 0
-        }
-        self.lrfb_servo = {
-            'widget': '', 'command': '', 'servo': object, 'current_position': 0, 'step':0
-        }
+    _LRFB_AXES = {'left': 'leftright', 'right': 'leftright', 'forward': 'forwardbackward',
+                  'backward': 'forwardbackward', 'brightness': 'brightness'}
 
-    def __del__(self):
-        self.wait()
-        print("Closing Servo Motor Thread.")
+    def __init__(self, positions):
+        QtCore.QObject.__init__(self)
+        self.positions = dict(positions)  # Last known position per axis, used by moves without current_position
+        self._scheduler = MotionScheduler(('updown', 'lens', 'leftright', 'forwardbackward', 'brightness'))
 
     def start_updown(self, items):
-        for key in self.updown_motor:
-            self.updown_motor[key] = items[key]
-        self.commands_queue.put(True)
-        self.running_updown = True
+        return self._scheduler.submit('updown', self._move_updown, dict(items))
 
     def stop_updown(self):
-        self.running_updown = False
+        self._scheduler.cancel('updown')
 
     def start_lens(self, items):
-        for key in self.lens_motor:
-            self.lens_motor[key] = items[key]
-        self.commands_queue.put(True)
-        self.running_lens = True
+        return self._scheduler.submit('lens', self._change_lens, dict(items))
 
     def stop_lens(self):
-        self.running_lens = False
+        self._scheduler.cancel('lens')
 
     def start_lrfb(self, items):
-        for key in self.lrfb_servo:
-            self.lrfb_servo[key] = items[key]
-        self.commands_queue.put(True)
-        self.running_lrfb = True
+        axis = self._LRFB_AXES.get(items['command'])
+        if axis is None:
+            print('Command not supported!')
+            return None
+        return self._scheduler.submit(axis, self._move_servo, dict(items))
 
     def stop_lrfb(self):
-        self.running_lrfb = False
-
-    def run(self):
-        while self.running_main:
-            queue_command = self.commands_queue.get()
-            print('Waiting for command...')
-            if self.running_updown:
-                self.started_updown.emit()
-                # print(f'UpdownWorker -> process_command: Setting New Position: {self.updown_motor["new_position"]}')
-                if self.updown_motor['new_position'] >= self.updown_motor['current_position']:
-                    direction = "up"
-                    steps = self.updown_motor['new_position'] - self.updown_motor['current_position']
-                elif self.updown_motor['new_position'] <= self.updown_motor['current_position']:
-                    direction = "down"
-                    steps = self.updown_motor['current_position'] - self.updown_motor['new_position']
-
-                for step in range(steps):
-                    if self.running_updown and direction == "up" and self.updown_motor['current_position'] < \
-                            self.updown_motor['max_position']:
-                        self.updown_motor['current_position'] += 1
-                        if check_dependency('RPi') is not None:
-                            self.updown_motor['motor'].rotate('ccw')
-                        else:
-                            sleep(1)
-                        self.ongoing_updown.emit(self.updown_motor['current_position'])
-                    elif self.running_updown and direction == "down" and self.updown_motor['current_position'] > \
-                            self.updown_motor['min_position']:
-                        self.updown_motor['current_position'] -= 1
-                        if check_dependency('RPi') is not None:
-                            self.updown_motor['motor'].rotate('cw')
-                        else:
-                            sleep(1)
-                        self.ongoing_updown.emit(self.updown_motor['current_position'])
-                    else:
-                        if self.updown_motor['current_position'] == self.updown_motor['max_position']:
-                            print("UpdownWoker -> process_command: Upper Limit Reached.")
-                        elif self.updown_motor['current_position'] == self.updown_motor['min_position']:
-                            print("UpdownWoker -> process_command: Lower Limit Reached.")
-                        else:
-                            print("UpdownWoker -> process_command: Process Canceled.")
-                        self.finished_updown.emit(self.updown_motor['current_position'])
-                        break
-                self.finished_updown.emit(self.updown_motor['current_position'])
-            elif self.running_lens:
-                self.started_lens.emit()
-                # 'motor': object, 'lens_index': 0, 'current_position': 0,
-                # 'p1': 0, 'p2': 0, 'p3': 0
-                motor = self.lens_motor['motor']
-                lens_index = self.lens_motor['lens_index']
-                current_position = self.lens_motor['current_position']
-                p1 = self.lens_motor['p1']
-                p2 = self.lens_motor['p2']
-                p3 = self.lens_motor['p3']
-                if lens_index == 0:
-                    # Rotate Stepper To next lens
-                    print('Changing Lens: 0->1')
-                    while self.running_lens and current_position < p2:  # 2000
-                        current_position += 1
-                        if check_dependency('RPi') is not None:
-                            motor.step_rotate('cw')
-                        else:
-                            sleep(0.5)
-                        self.ongoing_lens.emit(lens_index, current_position)
-
-                    if self.running_lens:
-                        lens_index = 1
-                        self.running_lens = False
-                        print('Cycle complete')
-                    else:
-                        print('Cycle incomplete.')
-                        # print(f'Current Position: {current_position} - Expected Position: {p2}')
-
-                elif lens_index == 1:
-                    # Rotate Stepper clockwise going to lens 2
-                    print('Changing Lens: 1->2')
-                    while self.running_lens and current_position < p3:  # 4000
-                        current_position += 1
-                        if check_dependency('RPi') is not None:
-                            motor.step_rotate('cw')
-                        else:
-                            sleep(0.5)
-                        self.ongoing_lens.emit(lens_index, current_position)
-
-                    if self.running_lens:
-                        lens_index = 2
-                        self.running_lens = False
-                        print('Cycle complete')
-                    else:
-                        print('Cycle incomplete.')
-                        # print(f'Current Position: {current_position} - Expected Position: {p3}')
-
-                elif lens_index == 2:
-                    # Rotate Stepper counter clockwise returning to lens 3
-                    print('Changing Lens: 2->0')
-                    while self.running_lens and current_position > p1:  # 0
-                        current_position -= 1
-                        if check_dependency('RPi') is not None:
-                            motor.step_rotate('ccw')
-                        else:
-                            sleep(0.5)
-                        self.ongoing_lens.emit(lens_index, current_position)
-
-                    if self.running_lens:
-                        lens_index = 0
-                        self.running_lens = False
-                        print('Cycle complete')
-                    else:
-                        print('Cycle incomplete.')
-                        # print(f'Current Position: {current_position} - Expected Position: {p1}')
-                self.finished_lens.emit(lens_index, current_position)
-            elif self.running_lrfb:
-                widget = self.lrfb_servo['widget']
-                command = self.lrfb_servo['command']
-                current_position = self.lrfb_servo['current_position']
-                servo = self.lrfb_servo['servo']
-                step = self.lrfb_servo['step']
-                print(servo)
-                if widget == 'button':
-                    if command == 'left':
-                        current_position += step
-                        if check_dependency('RPi') is not None:
-                            if 180 >= current_position >= 0:
-                                servo.set_angle(current_position)
-                                self.move_leftright.emit(current_position)
-                                print('Going left')
-                        else:
-                            if 180 >= current_position >= 0:
-                                self.move_leftright.emit(current_position)
-                    elif command == 'right':
-                        current_position -= step
-                        if check_dependency('RPi') is not None:
-                            if 180 >= current_position >= 0:
-                                servo.set_angle(current_position)
-                                self.move_leftright.emit(current_position)
-                        else:
-                            if 180 >= current_position >= 0:
-                                self.move_leftright.emit(current_position)
-                    elif command == 'forward':
-                        current_position += step
-                        if check_dependency('RPi') is not None:
-                            if 180 >= current_position >= 0:
-                                servo.set_angle(current_position)
-                        else:
-                            if 180 >= current_position >= 0:
-                                self.move_forwardbackward.emit(current_position)
-                    elif command == 'backward':
-                        current_position -= step
-                        if check_dependency('RPi') is not None:
-                            if 180 >= current_position >= 0:
-                                servo.set_angle(current_position)
-                        else:
-                            if 180 >= current_position >= 0:
-                                self.move_forwardbackward.emit(current_position)
-                    else:
-                        print('Command not supported!')
-                elif widget == 'slider':
-                    if command == 'brightness':
-                        if check_dependency('RPi') is not None:
-                            if 80 >= current_position >= 0:
-                                servo.set_angle(current_position)
-                                self.move_brightness.emit(current_position)
-                        else:
-                            if 80 >= current_position >= 0:
-                                self.move_brightness.emit(current_position)
-                    else:
-                        print('Command not supported!')
-                else:
-                    print('Widget not supported!')
+        for axis in ('leftright', 'forwardbackward', 'brightness'):
+            self._scheduler.cancel(axis)
+
+    def hold(self, *axes):  # For autofocus, z-stack and scan, which drive the motors themselves
+        return self._scheduler.hold(*axes)
+
+    def _move_updown(self, handle, updown_motor):  # To new_position, or by steps from wherever the stage is
+        self.started_updown.emit()
+        current_position = updown_motor.get('current_position', self.positions['updown'])
+        new_position = updown_motor.get('new_position', current_position + updown_motor.get('steps', 0))
+        # print(f'UpdownWorker -> process_command: Setting New Position: {new_position}')
+        target = min(max(new_position, updown_motor['min_position']), updown_motor['max_position'])
+        if target != new_position:
+            print("UpdownWoker -> process_command: {} Limit Reached.".format(
+                'Upper' if new_position > target else 'Lower'))
+        direction, sign = ('ccw', 1) if target >= current_position else ('cw', -1)
+        motor = updown_motor['motor']
+        start = current_position
+        move = motor.move_positions(direction, abs(target - start))  # One ramp for the whole distance
+        while not move.done():
+            if handle.cancelled():
+                move.cancel()
+            move.wait(0.05)
+            position = start + sign * (move.steps // motor.steps_per_position)
+            if position != current_position:
+                current_position = position
+                self.positions['updown'] = current_position
+                self.ongoing_updown.emit(current_position)
+        remainder = move.steps % motor.steps_per_position
+        if remainder:  # Cancelled part way through a position, finish it so positions stay whole
+            motor.move(direction, motor.steps_per_position - remainder).wait()
+            current_position += sign
+            self.positions['updown'] = current_position
+        if handle.cancelled():
+            print("UpdownWoker -> process_command: Process Canceled.")
+        self.finished_updown.emit(current_position)
+        return current_position
+
+    def _change_lens(self, handle, lens_motor):  # Lens 0 -> 1 -> 2 turn clockwise, 2 -> 0 turns back
+        self.started_lens.emit()
+        lens_index = lens_motor['lens_index']
+        current_position = lens_motor['current_position']
+        target, direction, sign = {
+            0: (lens_motor['p2'], 'cw', 1),
+            1: (lens_motor['p3'], 'cw', 1),
+            2: (lens_motor['p1'], 'ccw', -1),
+        }[lens_index]
+        print('Changing Lens: {0}->{1}'.format(lens_index, (lens_index + 1) % 3))
+        start = current_position
+        move = lens_motor['motor'].move(direction, max(0, (target - start) * sign))
+        while not move.done():
+            if handle.cancelled():
+                move.cancel()
+            move.wait(0.05)
+            current_position = start + sign * move.steps
+            self.positions['lens'] = current_position
+            self.ongoing_lens.emit(lens_index, current_position)
+        if current_position == target:
+            lens_index = (lens_index + 1) % 3
+            print('Cycle complete')
+        else:
+            print('Cycle incomplete.')
+            # print(f'Current Position: {current_position} - Expected Position: {target}')
+        self.finished_lens.emit(lens_index, current_position)
+        return lens_index, current_position
+
+    def _move_servo(self, handle, lrfb_servo):
+        command = lrfb_servo['command']
+        axis = self._LRFB_AXES[command]
+        current_position = lrfb_servo.get('current_position', self.positions[axis])
+        servo = lrfb_servo['servo']
+        step = lrfb_servo['step']
+        if command in ('left', 'forward'):
+            current_position += step
+        elif command in ('right', 'backward'):
+            current_position -= step
+        limit = 80 if command == 'brightness' else 180
+        current_position = min(max(current_position, 0), limit)  # A coalesced move stops at the end of travel
+        servo.set_angle(current_position)
+        self.positions[axis] = current_position
+        if command in ('left', 'right'):
+            self.move_leftright.emit(current_position)
+        elif command in ('forward', 'backward'):
+            self.move_forwardbackward.emit(current_position)
+        else:
+            self.move_brightness.emit(current_position)
+        return current_position
 
 
 class VideoServerThread(QtCore.QThread):
     client_accepted = QtCore.pyqtSignal()
-    client_disconnected = QtCore.pyqtSignal()
-    received_command = QtCore.pyqtSignal()
+    client_disconnected = QtCore.pyqtSignal(str)
 
-    def __init__(self, video_server, camera):
+    def __init__(self, video_server, camera, command_queue):
         QtCore.QThread.__init__(self)
         self._camera = camera
         self._server = video_server
         self._frame = None
 
-        self._command = {'name': '', 'command': ''}
-        self.client_to_remove = None
+        self._commands = command_queue
         self.newly_added_client = None
 
     def __del__(self):
@@ -1335,97 +1485,150 @@ class VideoServerThread(QtCore.QThread):
         print("Closing Server Thread.")
 
     def run(self):
-        self._client_listener()
-
-    def _client_listener(self):
-        handler_loop = asyncio.new_event_loop()
-        while self._server.is_listening:
-            print("Waiting for connections at: {0}".format(self._server.address))
-            conn, addr = self._server.accept_connection()
-            name = self._server.clients[conn]['name']
-            self.newly_added_client = conn
-            client_handler_thread = threading.Thread(
-                name="client-video-thread: {name}".format(name=name),
-                target=self._client_handler,
-                args=(conn,)
-            )
-            client_handler_thread.start()
-            # client_receiver_thread = threading.Thread(
-            #     name="client-receiver-thread",
-            #     target=self._client_receiver,
-            #     args=(conn,)
-            # ).start()
-            # handler_loop.run_until_complete(self._client_handler(conn))
-            # handler_loop.run_until_complete(self._client_receiver(conn))
+        self._serve()
+
+    def _serve(self):  # Single threaded loop multiplexing accept, commands and frame sends for every client
+        print("Waiting for connections at: {0}".format(self._server.address))
+        self._server.serve(self._camera.frame_bus, self._handle_event)
+
+    def _handle_event(self, event):
+        if event[0] == 'accepted':
+            self.newly_added_client = event[1]
             self.client_accepted.emit()
-        handler_loop.close()
+        elif event[0] == 'command':
+            conn, name, command = event[1:]
+            print(command)
+            self._commands.put(name, command)  # (request_id, command, value)
+        elif event[0] == 'disconnected':
+            print("Client {} disconnected.".format(event[2]))
+            self._commands.remove(event[2])
+            self.client_disconnected.emit(event[2])
+
+
+class CommunicationServerThread(QtCore.QThread):
+    def __init__(self, comm_server, command_queue):
+        QtCore.QThread.__init__(self)
+        self._server = comm_server
+        self._commands = command_queue
 
-    def _client_handler(self, conn):
-        with conn:
-            sent = True
-            try:
-                while sent:
-                    # if self._command.full():
-                    #     # print('Command Queue is full')
-                    #     self._command.get()
-                    # else:
-                    try:
-                        # print('Receiving command...')
-                        command = conn.recv(126)
-                        command = command.decode()
-                        if command == 'alive':
-                            pass
-                        else:
-                            if command:
-                                print(command)
-                                self._command['name'] = self._server.clients[conn]['name']
-                                self._command['command'] = command
-                                self.received_command.emit()
-                    except socket.error:
-                        print("Client: No Response.")
-
-                    # print('Sending frame')
-                    QThread.sleep(0.024)  # 24 frames per second
-                    # QThread.sleep(0.5)  # 2 frames per second
-                    sent = self._server.send_frame(conn, self._camera.image_byte)
-                    # while sent:
-                    #     sent = self._server.send_frame(conn, self._camera.image_byte)
-            except socket.error:
-                self.client_to_remove = conn
-                self.client_disconnected.emit()
-                print("Client {} disconnected. inside".format(conn))
-        self.client_to_remove = conn
-        self.client_disconnected.emit()
-        print("Client {} disconnected. outside".format(conn))
-
-    def _client_receiver(self, conn):
-        while conn:
-            if self._command.full():
-                self._command.get()
-            else:
-                try:
-                    print('Waiting for command from {name}'.format(name=self._server.clients[conn]['name']))
-                    command = conn.recv(1024)
-                    self._command.put(
-                        self._server.clients[conn]['name'],
-                        command)
-                    print('Command Received.')
-                    self.received_command.emit()
-                except socket.error:
-                    print("No command")
+    def __del__(self):
+        self.wait()
+        print("Closing Communication Server Thread.")
 
-    @property
-    def command(self):
-        return self._command
+    def run(self):
+        print("Waiting for control sessions at: {0}".format(self._server.address))
+        self._server.serve(self._handle_event)
+
+    def _handle_event(self, event):
+        if event[0] == 'command':
+            conn, name, command = event[1:]
+            self._commands.put(name, command)  # Same queue as the video socket, so both are coalesced together
+        elif event[0] == 'disconnected':
+            print("Control session of {} closed.".format(event[2]))
+
+
+class CommandThread(QtCore.QThread):
+    """Executes remote commands off the GUI thread, a coalesced batch per client at a time.
+
+    While an axis moves, further moves of that axis are summed into one pending move, started when the current
+    one is done: holding 'up' turns into a few long moves instead of a long queue of single steps. The thread
+    itself never waits for a move, so other axes, settings and clients are served meanwhile. Every request with
+    an id gets a 'done' event once its action finished, or an 'error' event, sent through report.
+    """
+    changed_zoom = pyqtSignal(int)
+    changed_brightness = pyqtSignal(int)
+
+    def __init__(self, command_queue, execute, report):
+        QtCore.QThread.__init__(self)
+        self._queue = command_queue
+        self._execute = execute  # execute(client, command, value) returns the MotionHandle of a move or a result
+        self._report = report  # report(client, message) sends a message to a client, from any thread
+        self._moving = {}  # Axis to the handle of its last move, until that move is done
+        self._pending = {}  # Axis to the [client, steps, request_ids] moves waiting for it
+        self._lock = threading.RLock()  # Also taken by done callbacks on the motion workers
+
+    def __del__(self):
+        self.wait()
+        print("Closing Command Thread.")
+
+    def run(self):
+        while True:
+            for client, received in self._queue.take():
+                for command, value, request_ids in commands.coalesce(received):
+                    with self._lock:
+                        if command in commands.AXES and command in self._moving:  # Moves are named after their axis
+                            self._add_pending(command, client, value, request_ids)
+                            continue
+                    self._run(client, command, value, request_ids)
+
+    def _add_pending(self, axis, client, value, request_ids):
+        pending = self._pending.setdefault(axis, [])
+        if pending and pending[-1][0] == client:
+            pending[-1][1] += value
+            pending[-1][2].extend(request_ids)
+        else:
+            pending.append([client, value, list(request_ids)])
+
+    def _run(self, client, command, value, request_ids):
+        if command in commands.AXES and not value:  # The moves cancelled out
+            self._answer(client, request_ids, {'type': 'done', 'command': command})
+            return
+        try:
+            result = self._execute(client, command, value)
+        except Exception as e:  # Rejected, or a bug: either way the thread must keep serving
+            print('Command: {}'.format(e))
+            self._answer(client, request_ids, {'type': 'error', 'command': command, 'error': str(e)})
+            return
+        if isinstance(result, MotionHandle):
+            with self._lock:
+                self._moving[result.axis] = result
+                result.add_done_callback(functools.partial(self._finished, client, request_ids, command))
+        else:
+            self._answer(client, request_ids, {'type': 'done', 'command': command, 'result': result})
+
+    def _finished(self, client, request_ids, command, handle):  # Runs on the motion worker of the axis
+        if handle.error is not None:
+            message = {'type': 'error', 'command': command, 'error': str(handle.error)}
+        else:
+            message = {'type': 'done', 'command': command, 'result': handle.result, 'cancelled': handle.cancelled()}
+        self._answer(client, request_ids, message)
+        with self._lock:
+            if self._moving.get(handle.axis) is not handle:  # A later move of the axis already took over
+                return
+            del self._moving[handle.axis]
+            for pending_client, value, pending_ids in self._pending.pop(handle.axis, []):
+                self._run(pending_client, handle.axis, value, pending_ids)
+
+    def _answer(self, client, request_ids, message):
+        for request_id in request_ids:
+            self._report(client, dict(message, id=request_id))
+
+
+class MjpegServerThread(QtCore.QThread):
+    def __init__(self, mjpeg_server, camera):
+        QtCore.QThread.__init__(self)
+        self._camera = camera
+        self._server = mjpeg_server
+
+    def __del__(self):
+        self.wait()
+        print("Closing MJPEG Server Thread.")
+
+    def run(self):
+        print("Serving MJPEG at: http://{0}:{1}/".format(*self._server.address))
+        self._server.serve(self._camera.frame_bus)
 
 
 class CameraThread(QtCore.QThread):
     ready_frame = QtCore.pyqtSignal()
+    measured_focus = QtCore.pyqtSignal(float)
 
-    def __init__(self, camera):
+    def __init__(self, camera, focus_meter=None):
         QtCore.QThread.__init__(self)
         self._camera = camera
+        self._focus_meter = focus_meter or FocusMeter()
         self._raw_frame = None
+        self._seq = 0  # Sequence number of the frame last read, this consumer's own cursor into the ring
 
     def __del__(self):
         self.wait()
@@ -1433,17 +1636,13 @@ class CameraThread(QtCore.QThread):
     def run(self):
         while self._camera.started:
             # Get frame from camera
-            retval, frame = self._camera.read_frame()
-            if retval:
-                font = cv2.FONT_HERSHEY_SIMPLEX
-                font_size = 0.8
-                thickness = 1
-                color = (255, 255, 255)
-                self._focus = cv2.Laplacian(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), cv2.CV_64F).var()
-                location = (4, 70)
-                text = "Blurred: {}".format(self._focus) if (
-                            self._focus < 100) else "Not Blurred: {}".format(self._focus)
-                cv2.putText(frame, text, location, font, font_size, color, thickness, cv2.LINE_AA)
+            self._seq, frame, timestamp = self._camera.read_frame(self._seq)
+            if frame is not None:
+                latency = self._camera.frame_bus.latency
+                start = time.monotonic()
+                if self._focus_meter.update(frame, timestamp):
+                    latency.record('focus', time.monotonic() - start)
+                    self.measured_focus.emit(self._focus_meter.value)
                 self._raw_frame = frame
                 self.ready_frame.emit()  # Emit signal indicating frame is ready
             else:
@@ -1466,24 +1665,31 @@ class CameraThread(QtCore.QThread):
         return self._raw_frame
 
     @property
-    def image_byte(self):
-        return self._camera.frame_queue
+    def frame_bus(self):
+        return self._camera.frame_bus
 
 
 class Camera:
-    def __init__(self, index):
+    def __init__(self, index, profiles=None, fps=24, ring_size=8):
         print("Camera: Initializing Camera")
         self._camera_index = index
         self._started = False
         self._capture = None
+        self._capture_thread = None
         self._zoom = 0
-        self._frame_queue = queue.Queue(5)
+        self._ring = FrameRing(ring_size)
+        self._frame_bus = FrameBus(profiles)
+        self._scheduler = FrameScheduler(fps)  # Frames are captured at sensor rate but streamed at this rate
 
-    def start(self):
+    def start(self, capture=None):
+        """Opens the camera. capture replaces the device with any object exposing VideoCapture's read/isOpened/release."""
         if not self._capture:
             print("Camera: Starting Camera.")
-            self._capture = cv2.VideoCapture(self._camera_index)
+            self._capture = capture or cv2.VideoCapture(self._camera_index)
             self._started = True
+            self._capture_thread = threading.Thread(name="camera-capture-thread", target=self._capture_loop)
+            self._capture_thread.daemon = True
+            self._capture_thread.start()
         else:
             print("Camera: Camera is already on.")
             self._started = False
@@ -1491,36 +1697,63 @@ class Camera:
     def stop(self):
         if self._capture.isOpened():
             print('Camera: Stopping camera.')
+            self._started = False
+            self._capture_thread.join()
             self._capture.release()
             self._capture = None
-            self._started = False
         else:
             print('Camera: Camera is already off/ Not yet started.')
             self._started = False
 
-    def read_frame(self):
-        """Returns an opencv numpy array frame. If false returns -1"""
-        if self._started:
-            ok, raw_frame = self._capture.read()
-            if self._zoom > 0:
-                raw_frame = self._zoom_image(raw_frame)
+    def _capture_loop(self):  # Reads at sensor rate into the ring, whatever the consumers are doing
+        while self._started:
+            slot = self._ring.next_slot()
+            ok, image = self._capture.read(slot) if slot is not None else self._capture.read()
             if ok:
-                # print('Camera: Adding frame to queue')
-                frame = raw_frame
-                self.frame_queue = frame
-                # frame = cv2.flip(raw_frame, 1)
-                # if img_type == 'image':
-                #     frame = self._convert_frame(frame)
-                # elif img_type == 'array':
-                #     frame = frame
-                # else:
-                #     frame = -1
-                # gray_image = cv2.cvtColor(fliped_frame, cv2.COLOR_BGR2GRAY)
+                self._ring.commit(image, time.time())  # Capture time, travels with the frame up to the client
             else:
-                frame = None
-            return ok, frame
-        else:
-            return False, None
+                print("Camera: Unable to read frame.")
+                sleep(0.1)
+
+    def read_frame(self, after_seq=0):
+        """Returns (seq, frame, timestamp) for the newest frame captured after the sequence number after_seq.
+
+        Each consumer passes the seq it got last, so consumers never take frames from each other. Frames captured
+        while the caller was busy are skipped. The frame is the caller's own copy, since the ring slot is reused
+        after ring_size - 1 newer frames. Returns (after_seq, None, None) when the camera is off or no frame came.
+        """
+        while self._started:
+            seq = self._ring.wait_for(after_seq, timeout=1)
+            entry = self._ring.get(seq) if seq is not None else None
+            if entry is None:
+                break
+            frame, timestamp = entry
+            if self._zoom > 0:
+                start = time.monotonic()
+                frame = self._zoom_image(frame)
+                self._frame_bus.latency.record('zoom', time.monotonic() - start)
+            else:
+                frame = frame.copy()
+            if self._ring.get(seq) is None:  # Capture lapped the ring while copying, the copy may be torn
+                continue
+            if self._scheduler.due():
+                self._publish_frame(frame, timestamp)
+            return seq, frame, timestamp
+        return after_seq, None, None
+
+    def grab(self, after=0, timeout=1):
+        """Returns a copy of the first unzoomed frame captured after the time.time() after, None on timeout."""
+        deadline = time.monotonic() + timeout
+        seq = self._ring.seq
+        while True:
+            entry = self._ring.get(seq)
+            if entry is not None and entry[1] > after:
+                frame = entry[0].copy()
+                if self._ring.get(seq) is not None:  # Not overwritten while copying
+                    return frame
+            seq = self._ring.wait_for(seq, deadline - time.monotonic())
+            if seq is None:
+                return None
 
     def _zoom_image(self, frame):
         h, w = frame.shape[:2]
@@ -1547,21 +1780,25 @@ class Camera:
         return self._started
 
     @property
-    def frame_queue(self):
-        return self._frame_queue.get()
-
-    @frame_queue.setter
-    def frame_queue(self, frame):
-        # retval, buffer = cv2.imencode('.jpg', frame)
-        encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), 40]
-        retval, buffer = cv2.imencode('.jpg', frame, encode_param)
-        if retval:
-            image_bytes = base64.b64encode(buffer)
-            frame = image_bytes
-            if self._frame_queue.full():
-                self._frame_queue.get()
-            else:
-                self._frame_queue.put(frame)
+    def frame_bus(self):
+        return self._frame_bus
+
+    def _publish_frame(self, frame, timestamp):  # Encode once per profile in use, shared by its clients
+        payloads = {}
+        start = time.monotonic()
+        for index in self._frame_bus.active_profiles():
+            profile = self._frame_bus.profiles[index]
+            image = frame
+            if profile['scale'] != 1:
+                image = cv2.resize(frame, None, fx=profile['scale'], fy=profile['scale'],
+                                   interpolation=cv2.INTER_AREA)
+            encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), profile['quality']]
+            retval, buffer = cv2.imencode('.jpg', image, encode_param)
+            if retval:
+                payloads[index] = buffer
+        if payloads:
+            self._frame_bus.latency.record('encode', time.monotonic() - start)
+        self._frame_bus.publish(payloads, timestamp)
 
 
 class PreferencesDialog(QDialog, preferences_ui.Ui_Dialog):
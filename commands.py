@@ -0,0 +1,111 @@
+import collections
+import json
+import threading
+
+MOVES = {  # Command to (axis, direction)
+    'up': ('updown', 1),
+    'down': ('updown', -1),
+    'left': ('leftright', 1),
+    'right': ('leftright', -1),
+    'forward': ('forwardbackward', 1),
+    'backward': ('forwardbackward', -1),
+}
+AXES = set(axis for axis, direction in MOVES.values())
+SETTINGS = ('zoom', 'brightness')  # Absolute values, only the latest one matters
+
+
+class CommandRejected(Exception):
+    """A command that is malformed or not allowed. request_id is the id of the request, when it is known."""
+
+    def __init__(self, reason, request_id=None):
+        Exception.__init__(self, reason)
+        self.request_id = request_id
+
+
+def parse(command):
+    """Splits 'name' or 'name:value' into (name, int value or None). Raises ValueError on a bad value."""
+    name, separator, value = command.strip().partition(':')
+    return name, int(value) if separator else None
+
+
+def decode(line):
+    """Reads one command line, either JSON such as {"id": 7, "command": "zoom", "value": 120} or text such as 'zoom:120'.
+
+    Returns (request_id, name, value). Text commands and JSON without an id have request_id None and get no
+    replies. Raises CommandRejected when the line cannot be read.
+    """
+    if not line.startswith('{'):
+        try:
+            name, value = parse(line)
+        except ValueError:
+            raise CommandRejected('Invalid command {}'.format(line))
+        return None, name, value
+    try:
+        message = json.loads(line)
+    except ValueError:
+        raise CommandRejected('Invalid JSON {}'.format(line))
+    request_id = message.get('id') if isinstance(message, dict) else None
+    if not isinstance(message, dict) or not isinstance(message.get('command'), str):
+        raise CommandRejected('Missing command', request_id)
+    value = message.get('value')
+    if value is not None and not isinstance(value, int):
+        raise CommandRejected('Value of {} must be an integer'.format(message['command']), request_id)
+    return request_id, message['command'], value
+
+
+def coalesce(commands):
+    """Merges decoded (request_id, name, value) commands into as few actions as possible, keeping their net effect.
+
+    Returns (name, value, request_ids) actions. Runs of moves on one axis become a single (axis, steps, ids) move,
+    which is 0 steps when the run cancels out. Each setting is kept once, with its last value, where that last
+    value was, and answers for every request of that setting. Anything else passes through.
+    """
+    last = {name: index for index, (request_id, name, value) in enumerate(commands) if name in SETTINGS}
+    setting_ids = collections.defaultdict(list)
+    for request_id, name, value in commands:
+        if name in SETTINGS and request_id is not None:
+            setting_ids[name].append(request_id)
+    actions = []
+    for index, (request_id, name, value) in enumerate(commands):
+        request_ids = [] if request_id is None else [request_id]
+        if name in MOVES:
+            axis, direction = MOVES[name]
+            if actions and actions[-1][0] == axis:
+                actions[-1] = (axis, actions[-1][1] + direction, actions[-1][2] + request_ids)
+            else:
+                actions.append((axis, direction, request_ids))
+        elif name not in SETTINGS:
+            actions.append((name, value, request_ids))
+        elif last[name] == index:
+            actions.append((name, value, setting_ids[name]))
+    return actions
+
+
+class CommandQueue:
+    """Unbounded FIFO of decoded commands per client, filled by the network thread and drained in batches.
+
+    put() never blocks, so the server loop is never held up and no command is dropped. take() hands over
+    everything queued since the last call, which is what lets a burst of commands be coalesced.
+    """
+
+    def __init__(self):
+        self._queues = collections.OrderedDict()
+        self._condition = threading.Condition()
+
+    def put(self, client, command):
+        with self._condition:
+            self._queues.setdefault(client, collections.deque()).append(command)
+            self._condition.notify()
+
+    def take(self, timeout=None):
+        """Blocks until commands are queued. Returns [(client, [commands])] in arrival order of the clients."""
+        with self._condition:
+            if not self._condition.wait_for(lambda: any(self._queues.values()), timeout):
+                return []
+            batches = [(client, list(commands)) for client, commands in self._queues.items() if commands]
+            self._queues.clear()
+        return batches
+
+    def remove(self, client):
+        with self._condition:
+            self._queues.pop(client, None)
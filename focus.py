@@ -0,0 +1,79 @@
+import threading
+import time
+
+import cv2
+
+
+def laplacian_variance(gray):
+    return float(cv2.Laplacian(gray, cv2.CV_64F).var())
+
+
+def tenengrad(gray):  # Mean squared Sobel gradient magnitude
+    gx = cv2.Sobel(gray, cv2.CV_32F, 1, 0, ksize=3)
+    gy = cv2.Sobel(gray, cv2.CV_32F, 0, 1, ksize=3)
+    return float(cv2.mean(gx * gx + gy * gy)[0])
+
+
+def normalized_variance(gray):  # Variance over mean, insensitive to illumination changes
+    mean, stddev = cv2.meanStdDev(gray)
+    mean = float(mean[0][0])
+    return float(stddev[0][0]) ** 2 / mean if mean else 0.0
+
+
+METRICS = {
+    'laplacian': laplacian_variance,
+    'tenengrad': tenengrad,
+    'normalized_variance': normalized_variance,
+}
+
+
+class FocusMeter:
+    """Measures sharpness on a downsampled center region every few frames.
+
+    roi is the fraction of the width and height kept around the center, pyramid the number of pyrDown halvings
+    applied to it and every the frame interval between measurements. The latest result is published as a
+    (value, timestamp) reading, where timestamp is the capture time of the measured frame.
+    """
+
+    def __init__(self, metric='laplacian', roi=0.5, pyramid=1, every=3):
+        self._metric = METRICS[metric]
+        self._roi = roi
+        self._pyramid = pyramid
+        self._every = max(1, every)
+        self._count = 0
+        self._reading = (0.0, 0.0)
+        self._condition = threading.Condition()
+
+    def update(self, frame, timestamp=None):
+        """Feeds a BGR frame. Returns True when this frame was measured."""
+        self._count += 1
+        if self._count % self._every:
+            return False
+        value = self.measure(frame)
+        with self._condition:
+            self._reading = (value, timestamp or time.time())
+            self._condition.notify_all()
+        return True
+
+    def measure(self, frame):
+        height, width = frame.shape[:2]
+        crop_h, crop_w = int(height * self._roi) // 2, int(width * self._roi) // 2
+        region = frame[height // 2 - crop_h:height // 2 + crop_h, width // 2 - crop_w:width // 2 + crop_w]
+        for level in range(self._pyramid):
+            region = cv2.pyrDown(region)
+        return self._metric(cv2.cvtColor(region, cv2.COLOR_BGR2GRAY))
+
+    def wait_for(self, timestamp, timeout=None):
+        """Blocks until a frame captured after timestamp was measured. Returns its reading, None on timeout."""
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._reading[1] > timestamp, timeout):
+                return None
+            return self._reading
+
+    @property
+    def reading(self):
+        return self._reading
+
+    @property
+    def value(self):
+        return self._reading[0]
@@ -0,0 +1,171 @@
+import base64
+import threading
+import time
+
+from latency import LatencyStats
+
+DEFAULT_PROFILES = [{'quality': 40, 'scale': 1.0}]
+DEMAND_TIMEOUT = 2  # Seconds a profile keeps being encoded after its last reader asked for it
+
+
+class Frame:
+    """A single camera frame shared by every consumer of the bus, encoded once per requested profile."""
+    __slots__ = ('seq', 'timestamp', 'payloads', '_legacy_payloads', '_bus')
+
+    def __init__(self, seq, timestamp, payloads, bus):
+        self.seq = seq
+        self.timestamp = timestamp
+        self.payloads = payloads  # Raw JPEG bytes keyed by profile index
+        self._legacy_payloads = {}
+        self._bus = bus
+
+    def payload(self, profile=0):
+        """Returns the JPEG for a profile, or the closest profile that was encoded for this frame.
+
+        Asking for a profile keeps it in demand so the following frames are encoded with it. Returns None when
+        the frame was not encoded at all (nobody was reading when it was captured).
+        """
+        self._bus.request(profile)
+        if profile in self.payloads:
+            return self.payloads[profile]
+        if not self.payloads:
+            return None
+        return self.payloads[min(self.payloads, key=lambda encoded: abs(encoded - profile))]
+
+    def legacy_payload(self, profile=0):  # Base64 copy for v1 clients, built at most once per frame and profile
+        if profile not in self._legacy_payloads:
+            payload = self.payload(profile)
+            self._legacy_payloads[profile] = None if payload is None else base64.b64encode(payload)
+        return self._legacy_payloads[profile]
+
+
+class FrameBus:
+    """Broadcast holder for the latest encoded frame.
+
+    The camera publishes each frame once and every reader gets the same buffer. Reading never consumes
+    the frame, so any number of clients can follow the stream at full rate. Frames are encoded with each
+    quality/scale profile that readers asked for recently, and with nothing when nobody is watching.
+    """
+
+    def __init__(self, profiles=None):
+        self._condition = threading.Condition()
+        self._frame = None
+        self._seq = 0
+        self._profiles = profiles or DEFAULT_PROFILES
+        self._requests = {}
+        self._listeners = []
+        self.latency = LatencyStats()  # Shared by every stage from capture to the network
+
+    def publish(self, payloads, timestamp=None):
+        """Publishes a new frame. timestamp is the wall clock capture time, defaulting to now."""
+        with self._condition:
+            self._seq += 1
+            self._frame = Frame(self._seq, timestamp or time.time(), payloads, self)
+            self._condition.notify_all()
+        for listener in self._listeners:
+            listener()
+        return self._seq
+
+    def add_listener(self, listener):
+        """Registers a callable invoked from the publishing thread after every new frame."""
+        self._listeners.append(listener)
+
+    def latest(self):
+        """Returns the most recent frame or None if nothing was published yet."""
+        return self._frame
+
+    def wait_for(self, seq, timeout=None):
+        """Blocks until a frame newer than seq is published. Returns None on timeout."""
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._seq > seq, timeout):
+                return None
+            return self._frame
+
+    def request(self, profile):
+        self._requests[profile] = time.monotonic()
+
+    def active_profiles(self):
+        """Returns the indexes of the profiles readers asked for within DEMAND_TIMEOUT."""
+        now = time.monotonic()
+        return [profile for profile, requested in list(self._requests.items())
+                if now - requested < DEMAND_TIMEOUT and profile < len(self._profiles)]
+
+    @property
+    def profiles(self):
+        return self._profiles
+
+    @property
+    def seq(self):
+        return self._seq
+
+
+class FrameScheduler:
+    """Paces work to a target frame rate on the monotonic clock.
+
+    Deadlines advance by a fixed interval, so an occasional slow frame does not shift the whole schedule. When
+    the caller falls more than a frame behind, the schedule restarts from now instead of bursting to catch up.
+    """
+
+    def __init__(self, fps):
+        self._interval = 1.0 / fps
+        self._deadline = time.monotonic()
+
+    def due(self):
+        """Returns True, and moves to the next deadline, once the current deadline has passed."""
+        now = time.monotonic()
+        if now < self._deadline:
+            return False
+        self._deadline += self._interval
+        if self._deadline <= now:
+            self._deadline = now + self._interval
+        return True
+
+    @property
+    def interval(self):
+        return self._interval
+
+
+class FrameRing:
+    """Fixed ring of reusable frame buffers filled by the capture thread and read by sequence number.
+
+    The producer asks for next_slot(), reads the camera into it and commits it. After one lap every slot is
+    allocated and capture never allocates again. A frame stays valid until size - 1 newer frames have been
+    committed, so consumers that need it longer must copy it.
+    """
+
+    def __init__(self, size=8):
+        self._size = size
+        self._slots = [None] * size
+        self._timestamps = [0.0] * size
+        self._seq = 0
+        self._condition = threading.Condition()
+
+    def next_slot(self):
+        """Returns the buffer the next frame should be read into, None until that slot was first filled."""
+        return self._slots[(self._seq + 1) % self._size]
+
+    def commit(self, image, timestamp):
+        index = (self._seq + 1) % self._size
+        with self._condition:
+            self._slots[index] = image
+            self._timestamps[index] = timestamp
+            self._seq += 1
+            self._condition.notify_all()
+
+    def get(self, seq):
+        """Returns (image, timestamp) for a sequence number, or None once its slot is being reused."""
+        if seq < 1 or not self._seq - self._size + 1 < seq <= self._seq:
+            return None
+        index = seq % self._size
+        return self._slots[index], self._timestamps[index]
+
+    def wait_for(self, seq, timeout=None):
+        """Blocks until a frame newer than seq is committed and returns the newest sequence, None on timeout."""
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._seq > seq, timeout):
+                return None
+            return self._seq
+
+    @property
+    def seq(self):
+        return self._seq
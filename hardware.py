@@ -0,0 +1,155 @@
+import collections
+import threading
+import time
+
+try:
+    import RPi.GPIO as GPIO
+    import Adafruit_PCA9685
+except (ImportError, RuntimeError):  # RPi.GPIO raises RuntimeError when imported off a Raspberry Pi
+    GPIO = None
+    Adafruit_PCA9685 = None
+
+HIGH = 1
+LOW = 0
+
+# Resolved once at import. Threads consult this instead of probing the import system on every motor step.
+CAPABILITIES = {
+    'gpio': GPIO is not None,
+    'pca9685': Adafruit_PCA9685 is not None,
+}
+
+
+def has(capability):
+    return CAPABILITIES.get(capability, False)
+
+
+class RPiBackend:
+    """Drives the real pins through RPi.GPIO (BCM numbering) and servos through a PCA9685 board."""
+    name = 'rpi'
+
+    def __init__(self):
+        GPIO.setmode(GPIO.BCM)
+
+    def setup_output(self, pins):
+        GPIO.setup(pins, GPIO.OUT)
+
+    def output(self, pins, values):
+        GPIO.output(pins, values)
+
+    def pwm(self, pin, frequency):
+        return GPIO.PWM(pin, frequency)
+
+    def pca9685(self):
+        return Adafruit_PCA9685.PCA9685()
+
+    def cleanup(self):
+        GPIO.cleanup()
+
+    def link_stepper(self, step_pin, dir_pin):  # Real steppers need no model
+        pass
+
+
+class SimulatedPWM:
+    def __init__(self, backend, pin, frequency):
+        self._backend = backend
+        self.pin = pin
+        self.frequency = frequency
+        self.duty = 0
+
+    def start(self, duty):
+        self.ChangeDutyCycle(duty)
+
+    def ChangeDutyCycle(self, duty):
+        self.duty = duty
+        self._backend.record(('pwm', self.pin), duty)
+
+    def stop(self):
+        self.ChangeDutyCycle(0)
+
+
+class SimulatedPCA9685:
+    def __init__(self, backend):
+        self._backend = backend
+        self.frequency = None
+        self.ticks = {}  # Channel to the tick the pulse ends on, 0 when the output is off
+
+    def set_pwm_freq(self, frequency):
+        self.frequency = frequency
+
+    def set_pwm(self, channel, on, off):
+        self.ticks[channel] = off
+        self._backend.record(('pca9685', channel), off)
+
+
+class SimulatedBackend:
+    """Stands in for the Raspberry Pi on any machine.
+
+    Every output is recorded as a (monotonic time, pin, value) edge, keeping the last history_size of them,
+    so timing and ordering can be checked after the fact. Stepper positions are modelled by counting the
+    rising edges of a step pin, signed by the level of the direction pin at that moment.
+    """
+    name = 'simulated'
+
+    def __init__(self, history_size=100000):
+        self.edges = collections.deque(maxlen=history_size)
+        self.levels = {}
+        self.steps = collections.Counter()  # (step pin, direction level) to rising edges
+        self._directions = {}
+        self._lock = threading.Lock()
+
+    def setup_output(self, pins):
+        for pin in self._pins(pins):
+            self.levels.setdefault(pin, LOW)
+
+    def output(self, pins, values):
+        pins = self._pins(pins)
+        values = values if isinstance(values, (list, tuple)) else [values] * len(pins)
+        for pin, value in zip(pins, values):
+            value = HIGH if value else LOW
+            if value == HIGH and self.levels.get(pin) == LOW and pin in self._directions:
+                self.steps[pin, self.levels.get(self._directions[pin], LOW)] += 1
+            self.levels[pin] = value
+            self.record(pin, value)
+
+    def pwm(self, pin, frequency):
+        return SimulatedPWM(self, pin, frequency)
+
+    def pca9685(self):
+        return SimulatedPCA9685(self)
+
+    def cleanup(self):
+        self.levels.clear()
+
+    def record(self, pin, value):
+        with self._lock:
+            self.edges.append((time.monotonic(), pin, value))
+
+    def link_stepper(self, step_pin, dir_pin):
+        """Models the position of a stepper driven by step_pin, in the direction set on dir_pin."""
+        self._directions[step_pin] = dir_pin
+
+    def position(self, step_pin, forward=HIGH):
+        """Steps taken by a linked stepper, counting steps with the direction pin at forward as positive."""
+        backward = LOW if forward == HIGH else HIGH
+        return self.steps[step_pin, forward] - self.steps[step_pin, backward]
+
+    @staticmethod
+    def _pins(pins):
+        return list(pins) if isinstance(pins, (list, tuple)) else [pins]
+
+
+_backend = None
+
+
+def default_backend():
+    """Returns the backend shared by every motor: the Raspberry Pi when its libraries load, else a simulation."""
+    global _backend
+    if _backend is None:
+        _backend = RPiBackend() if has('gpio') and has('pca9685') else SimulatedBackend()
+        print('Hardware: Using the {} backend.'.format(_backend.name))
+    return _backend
+
+
+def set_backend(backend):
+    global _backend
+    _backend = backend
@@ -0,0 +1,44 @@
+import collections
+import threading
+
+
+class LatencyStats:
+    """Keeps the most recent latency samples of every pipeline stage and reports their percentiles.
+
+    Samples are seconds. Stages are created on first use, so any part of the pipeline can record into the
+    same instance without registering first.
+    """
+    PERCENTILES = (50, 95, 99)
+
+    def __init__(self, size=1000):
+        self._size = size
+        self._samples = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def record(self, stage, seconds):
+        samples = self._samples.get(stage)
+        if samples is None:
+            with self._lock:
+                samples = self._samples.setdefault(stage, collections.deque(maxlen=self._size))
+        samples.append(seconds)
+
+    def percentiles(self, stage):
+        """Returns {'count': n, 'p50': ms, 'p95': ms, 'p99': ms} for a stage, or None without samples."""
+        samples = sorted(self._samples.get(stage, ()))
+        if not samples:
+            return None
+        result = {'count': len(samples)}
+        for percentile in self.PERCENTILES:
+            index = min(len(samples) - 1, int(round(percentile / 100.0 * (len(samples) - 1))))
+            result['p{0}'.format(percentile)] = samples[index] * 1000
+        return result
+
+    def summary(self):
+        """Returns the percentiles of every stage, in the order the stages were first recorded."""
+        with self._lock:
+            stages = list(self._samples)
+        return {stage: self.percentiles(stage) for stage in stages}
+
+    def __str__(self):
+        return ' | '.join('{stage}: p50 {p50:.1f} p95 {p95:.1f} p99 {p99:.1f} ms'.format(stage=stage, **values)
+                          for stage, values in self.summary().items() if values)
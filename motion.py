@@ -0,0 +1,154 @@
+import collections
+import contextlib
+import itertools
+import queue
+import threading
+
+DEFAULT_CONFLICTS = (('lens', 'updown'),)  # No lens swap while the stage moves in Z
+
+
+class MotionHandle:
+    """Handle on a job submitted to a MotionScheduler axis."""
+
+    def __init__(self, axis):
+        self.axis = axis
+        self.result = None
+        self.error = None
+        self._cancelled = False
+        self._done = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def cancel(self):
+        """Asks the job to stop. Jobs poll cancelled() between steps, a queued job is skipped."""
+        self._cancelled = True
+
+    def cancelled(self):
+        return self._cancelled
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """Blocks until the job finished. Returns its result, None on timeout or when it was skipped."""
+        self._done.wait(timeout)
+        return self.result
+
+    def add_done_callback(self, callback):
+        """Calls callback(handle) once the job is done, on the axis worker thread, or right away if it already is."""
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def _finish(self):
+        with self._lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception as e:
+                print('Motion: {0} done callback failed: {1}'.format(self.axis, e))
+
+
+class MotionScheduler:
+    """Runs motion jobs with one worker thread per axis, so independent axes move in parallel.
+
+    submit() queues a job and returns at once. Jobs on the same axis run in submission order. conflicts lists
+    the axis pairs that must never move together: a job waits for the conflicting axis to be idle before it
+    starts, and keeps it waiting until it is done. Conflicting jobs start in the order they were submitted.
+    """
+
+    def __init__(self, axes, conflicts=DEFAULT_CONFLICTS):
+        self._conflicts = collections.defaultdict(set)
+        for first, second in conflicts:
+            self._conflicts[first].add(second)
+            self._conflicts[second].add(first)
+        self._queues = {}
+        self._current = {}
+        self._active = set()
+        self._held = set()  # Axes moved directly by a hold() owner
+        self._holds = {}  # Ticket of a pending hold() to the axes it waits for
+        self._waiting = {}  # Axis to the ticket of the job it is about to start
+        self._tickets = itertools.count()
+        self._condition = threading.Condition()
+        for axis in axes:
+            self._queues[axis] = queue.Queue()
+            self._current[axis] = None
+            worker = threading.Thread(name='motion-{}-thread'.format(axis), target=self._work, args=(axis,))
+            worker.daemon = True
+            worker.start()
+
+    def submit(self, axis, job, *args):
+        """Queues job(handle, *args) on axis. Returns its MotionHandle without waiting."""
+        handle = MotionHandle(axis)
+        self._queues[axis].put((next(self._tickets), handle, job, args))
+        return handle
+
+    def cancel(self, axis):
+        """Cancels the running job and every queued job of an axis."""
+        current = self._current[axis]
+        if current is not None:
+            current.cancel()
+        pending = self._queues[axis]
+        with pending.mutex:
+            for ticket, handle, job, args in pending.queue:
+                handle.cancel()
+
+    def busy(self, axis):
+        return axis in self._active or axis in self._held or not self._queues[axis].empty()
+
+    @contextlib.contextmanager
+    def hold(self, *axes):
+        """Reserves axes for a caller that drives their motors itself, such as an autofocus search.
+
+        Waits until no job moves the axes or an axis in conflict with them. Jobs submitted while the hold lasts
+        stay queued and run once it is released.
+        """
+        blocked = set(axes).union(*(self._conflicts[axis] for axis in axes))
+        with self._condition:
+            ticket = next(self._tickets)  # Jobs submitted after the hold was asked for wait for it
+            self._holds[ticket] = blocked
+            self._condition.wait_for(lambda: not blocked & (self._active | self._held) and
+                                     not any(self._waiting.get(axis, ticket) < ticket for axis in blocked) and
+                                     not self._held_before(blocked, ticket))
+            del self._holds[ticket]
+            self._held.update(axes)
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._held.difference_update(axes)
+                self._condition.notify_all()
+
+    def _work(self, axis):
+        while True:
+            ticket, handle, job, args = self._queues[axis].get()
+            self._current[axis] = handle
+            if not handle.cancelled():
+                with self._condition:
+                    self._waiting[axis] = ticket
+                    self._condition.wait_for(lambda: self._can_start(axis, ticket))
+                    del self._waiting[axis]
+                    self._active.add(axis)
+                try:
+                    handle.result = job(handle, *args)
+                except Exception as e:
+                    handle.error = e
+                    print('Motion: {0} job failed: {1}'.format(axis, e))
+                finally:
+                    with self._condition:
+                        self._active.discard(axis)
+                        self._condition.notify_all()
+            self._current[axis] = None
+            handle._finish()
+
+    def _can_start(self, axis, ticket):
+        return axis not in self._held and not self._held_before({axis}, ticket) and not any(
+            other in self._active or other in self._held or self._waiting.get(other, ticket) < ticket
+            for other in self._conflicts[axis])
+
+    def _held_before(self, axes, ticket):  # True while a hold asked for earlier waits for one of the axes
+        return any(other < ticket and axes & blocked for other, blocked in self._holds.items())
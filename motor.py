@@ -1,18 +1,20 @@
+import math
+import queue
+import threading
+import time
 from time import sleep
-import RPi.GPIO as GPIO
-import Adafruit_PCA9685
 
-GPIO.setmode(GPIO.BCM)
+from hardware import HIGH, LOW, default_backend
 
 # Pulse Width = 1/Freq = 1/50 = 20 ms = 0.02 seconds
 # Time per tick = 4.88x10^-6
 
 
 class AdaServo:
-    def __init__(self, channel, frequency):
+    def __init__(self, channel, frequency, backend=None):
         self.channel = channel
         self.frequency = frequency
-        self.pwm = Adafruit_PCA9685.PCA9685()
+        self.pwm = (backend or default_backend()).pca9685()
         self.pwm.set_pwm_freq(self.frequency)
 
     # def set_angle(self, min_tick, max_tick):
@@ -43,9 +45,10 @@ class AdaServo:
 
 
 class Servo:
-    def __init__(self, pin):
+    def __init__(self, pin, backend=None):
         self.pin = pin
-        GPIO.setup(pin, GPIO.OUT)  # PWM PINS 17
+        self._backend = backend or default_backend()
+        self._backend.setup_output(pin)  # PWM PINS 17
 
         self._setup()
 
@@ -54,7 +57,7 @@ class Servo:
         self.pwm.stop()
 
     def _setup(self):
-        self.pwm = GPIO.PWM(self.pin, 50)  # Frequency is 50Hz
+        self.pwm = self._backend.pwm(self.pin, 50)  # Frequency is 50Hz
         self.pwm.start(2.5)
 
     def set_pin(self, pin):
@@ -63,13 +66,54 @@ class Servo:
 
     def set_angle(self, angle):
         duty = angle / 18 + 2
-        GPIO.output(self.pin, True)
+        self._backend.output(self.pin, HIGH)
         self.pwm.ChangeDutyCycle(duty)
         sleep(0.5)
-        GPIO.output(self.pin, False)
+        self._backend.output(self.pin, LOW)
         self.pwm.ChangeDutyCycle(0)
 
 
+def trapezoid_intervals(steps, start_interval, min_interval, ramp_steps):
+    """Returns the time between consecutive steps of a move with constant acceleration and deceleration.
+
+    The speed ramps from 1 / start_interval up to 1 / min_interval over ramp_steps, cruises, and ramps back
+    down symmetrically. Short moves that cannot reach full speed get a triangular profile.
+    """
+    start_speed, max_speed = 1.0 / start_interval, 1.0 / min_interval
+    acceleration = (max_speed ** 2 - start_speed ** 2) / (2.0 * max(1, ramp_steps))
+    intervals = []
+    for index in range(steps):
+        distance = min(index, steps - 1 - index)  # Steps from the nearest end of the move
+        intervals.append(1.0 / min(max_speed, math.sqrt(start_speed ** 2 + 2 * acceleration * distance)))
+    return intervals
+
+
+class StepperMove:
+    """Handle on a move queued on a Stepper. The move runs on the stepper's timing thread."""
+
+    def __init__(self, direction, intervals):
+        self.direction = direction
+        self.intervals = intervals
+        self.steps = 0  # Steps emitted so far
+        self._cancelled = False
+        self._done = threading.Event()
+
+    def cancel(self):
+        """Stops the move, decelerating over as many steps as it took to reach the current speed."""
+        self._cancelled = True
+
+    def cancelled(self):
+        return self._cancelled
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """Blocks until the move finished or was cancelled. Returns the number of steps emitted."""
+        self._done.wait(timeout)
+        return self.steps
+
+
 class Stepper:
     # _DIR = 20   # Direction GPIO Pin
     # _STEP = 21  # Step GPIO Pin
@@ -79,7 +123,8 @@ class Stepper:
     # _SPR = 200   # Steps per Revolution (360 / 1.8)
     # _DELAY = .0208  # Affects the speed of the rotation
 
-    def __init__(self, dir=None, step=None, step_angle=1.8, delay=0.0208, resolution=None, mode_pins=None):
+    def __init__(self, dir=None, step=None, step_angle=1.8, delay=0.0208, resolution=None, mode_pins=None,
+                 speedup=3, ramp_steps=400, backend=None):
         self._RESOLUTION_VALUE = {
             '1': (0, 0, 0),
             '2': (1, 0, 0),
@@ -95,6 +140,7 @@ class Stepper:
         self._DELAY = delay
         self._RESOLUTION = resolution
         self._MODE_PINS = mode_pins  # Microstep Resolution GPIO Pins
+        self._backend = backend or default_backend()
         self._step_count = self._SPR
 
         self.setup_pins()
@@ -102,12 +148,21 @@ class Stepper:
         self._step_count = int(self._SPR * self._RESOLUTION)  # calculate number of steps multiplied to resolution
         self._DELAY = self._DELAY / self._RESOLUTION  # delay is divided by resolution to reduce the delay due to higher number of steps
 
+        # Moves start at the old fixed rate, known not to miss steps, and ramp up to speedup times that rate
+        self._SPEEDUP = speedup
+        self._RAMP_STEPS = ramp_steps
+        self._moves = queue.Queue()
+        self._timing_thread = threading.Thread(name='stepper-{}-timing-thread'.format(step), target=self._timing_loop)
+        self._timing_thread.daemon = True
+        self._timing_thread.start()
+
     def setup_pins(self):
-        GPIO.setup(self._DIR, GPIO.OUT)  # Pin for direction
-        GPIO.setup(self._STEP, GPIO.OUT)  # Pin for step
-        GPIO.output(self._DIR, self._CW)  # Output direction for pin
-        GPIO.setup(self._MODE_PINS, GPIO.OUT)  # Pin for mode m0,m1,m2
-        GPIO.output(self._MODE_PINS, self._RESOLUTION_VALUE[str(self._RESOLUTION)])  # Output for mode
+        self._backend.setup_output(self._DIR)  # Pin for direction
+        self._backend.setup_output(self._STEP)  # Pin for step
+        self._backend.output(self._DIR, self._CW)  # Output direction for pin
+        self._backend.setup_output(self._MODE_PINS)  # Pin for mode m0,m1,m2
+        self._backend.output(self._MODE_PINS, self._RESOLUTION_VALUE[str(self._RESOLUTION)])  # Output for mode
+        self._backend.link_stepper(self._STEP, self._DIR)
 
     def change_settings(self, dir=None, step=None, step_angle=1.8, delay=0.0208, resolution=32, mode_pins=(None, None, None)):
         settings = [self._DIR, self._STEP, self._STEP, self._DELAY, self._RESOLUTION, self._MODE_PINS]
@@ -140,31 +195,66 @@ class Stepper:
     #     elif type == 'mode':
     #         self._MODE_PINS = value
 
-    def rotate(self, drc):  # move stepper by half the max step count 6400/2 = 3200 half rotation
-        self._set_direction(drc)
-        for i in range(int(self._step_count)/4):
-            self._move()
+    def rotate(self, drc):  # move stepper by a quarter of the max step count 6400/4 = 1600
+        self.move_positions(drc, 1).wait()
+
+    def move_positions(self, drc, positions):
+        """Queues a single ramped move of positions stage positions, one position being a quarter turn."""
+        return self.move(drc, positions * self.steps_per_position)
+
+    @property
+    def steps_per_position(self):
+        return self._step_count // 4
 
     def steps_rotate(self, drc, steps):
-        self._set_direction(drc)
-        for i in range(steps):
-            self._move()
+        self.move(drc, steps).wait()
+
+    def move(self, drc, steps):
+        """Queues a ramped move of steps in direction drc and returns its StepperMove without waiting for it."""
+        period = 2 * self._DELAY
+        move = StepperMove(drc, trapezoid_intervals(steps, period, period / self._SPEEDUP, self._RAMP_STEPS))
+        self._moves.put(move)
+        return move
+
+    def _timing_loop(self):  # Emits steps on monotonic deadlines so sleep overshoot does not add up
+        while True:
+            move = self._moves.get()
+            self._set_direction(move.direction)
+            intervals = move.intervals
+            deadline = time.monotonic()
+            stopping = False
+            index = 0
+            while index < len(intervals):
+                if move.cancelled() and not stopping:  # The last steps of the table ramp down from this speed
+                    stopping = True
+                    remaining = min(index, len(intervals) - index)
+                    intervals = intervals[:index] + intervals[len(intervals) - remaining:]
+                    continue
+                self._backend.output(self._STEP, HIGH)  # The GPIO calls alone exceed the driver's minimum pulse width
+                self._backend.output(self._STEP, LOW)
+                move.steps += 1
+                now = time.monotonic()
+                # Catch up on sleep overshoot, but never with a burst of steps the motor could not follow
+                deadline = max(deadline + intervals[index], now + intervals[index] / 2)
+                sleep(deadline - now)
+                index += 1
+            move._done.set()
 
     def step_rotate(self, drc):  # Move the stepper motor only by one step
         self._set_direction(drc)
         self._move()
 
     def _move(self):
-        GPIO.output(self._STEP, GPIO.HIGH)
+        self._backend.output(self._STEP, HIGH)
         sleep(self._DELAY)
-        GPIO.output(self._STEP, GPIO.LOW)
+        self._backend.output(self._STEP, LOW)
         sleep(self._DELAY)
 
     def _set_direction(self, drc):
         if drc == 'cw':
-            GPIO.output(self._DIR, self._CW)
+            self._backend.output(self._DIR, self._CW)
         elif drc == 'ccw':
-            GPIO.output(self._DIR, self._CCW)
+            self._backend.output(self._DIR, self._CCW)
 
     def __str__(self):
         return ('Settings:\nDirection:{}\nStep:{}\nDelay:{}\nSPR:{}\nResolution:{}\nMode:{}'.format(
@@ -206,6 +296,3 @@ class Stepper:
 #         stepper.rotate('cw')
 #         total_steps += 1
 #     print('Steps: ' + str(total_steps))
-
-
-GPIO.cleanup()
\ No newline at end of file
@@ -0,0 +1,135 @@
+import os
+
+import cv2
+import numpy as np
+
+SERVO_RANGE = (0, 180)  # Angles the stage servos accept
+PYRAMID_MARGIN = 2  # Source rows the 5x5 pyrDown kernel reaches beyond the rows it halves
+
+
+def grid_positions(x, y, columns, rows, step, limits=SERVO_RANGE):
+    """Returns (column, row, x, y) for every tile of the grid starting at servo position (x, y).
+
+    Rows are visited in alternating directions so the stage never travels back across the slide. Raises
+    ValueError when the grid does not fit within limits, the lowest and highest servo angle.
+    """
+    low, high = limits
+    last_x, last_y = x + (columns - 1) * step, y + (rows - 1) * step
+    if not all(low <= angle <= high for angle in (x, y, last_x, last_y)):
+        raise ValueError('Scan from ({0}, {1}) to ({2}, {3}) leaves the servo range {4}..{5}'.format(
+            x, y, last_x, last_y, low, high))
+    positions = []
+    for row in range(rows):
+        order = range(columns) if row % 2 == 0 else reversed(range(columns))
+        positions.extend((column, row, x + column * step, y + row * step) for column in order)
+    return positions
+
+
+def _gray(image):
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    return np.float32(image)
+
+
+def register(reference, tile, offset, min_response=0.1):
+    """Refines the expected pixel offset (dx, dy) of tile relative to reference by phase correlation.
+
+    Only the region both tiles should share is correlated, so the residual shift is small and cannot wrap
+    around. Returns (offset, response); the expected offset is kept when the correlation is too weak to trust.
+    """
+    dx, dy = offset
+    height, width = tile.shape[:2]
+    x0, x1 = max(0, dx), min(width, width + dx)
+    y0, y1 = max(0, dy), min(height, height + dy)
+    if x1 - x0 < 16 or y1 - y0 < 16:
+        return offset, 0.0
+    overlap_reference = _gray(reference[y0:y1, x0:x1])
+    overlap_tile = _gray(tile[y0 - dy:y1 - dy, x0 - dx:x1 - dx])
+    window = cv2.createHanningWindow((x1 - x0, y1 - y0), cv2.CV_32F)
+    (shift_x, shift_y), response = cv2.phaseCorrelate(overlap_tile, overlap_reference, window)
+    if response < min_response:
+        return offset, response
+    return (dx + int(round(shift_x)), dy + int(round(shift_y))), response
+
+
+class Mosaic:
+    """Mosaic canvas kept in a memory-mapped .npy file, so only the tiles being written are in RAM.
+
+    stride is the expected (dx, dy) pixel offset between neighbouring tiles. Each tile is placed relative to the
+    tile captured before it, at the stride refined by register(), and the first tile at its nominal position.
+    """
+
+    def __init__(self, path, columns, rows, tile_shape, stride, margin=64):
+        self._stride = stride
+        self._tile_shape = tile_shape
+        height, width = tile_shape[:2]
+        x_range = [0, (columns - 1) * stride[0]]
+        y_range = [0, (rows - 1) * stride[1]]
+        self._origin = (margin - min(x_range), margin - min(y_range))
+        shape = (max(y_range) - min(y_range) + height + 2 * margin,
+                 max(x_range) - min(x_range) + width + 2 * margin) + tuple(tile_shape[2:])
+        self._path = path
+        self._canvas = np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8, shape=shape)
+        self._previous = None  # (column, row, tile, (x, y)) of the last tile added
+
+    def add(self, column, row, tile):
+        """Places a tile of grid cell (column, row). Returns its top left pixel on the canvas."""
+        nominal = (self._origin[0] + column * self._stride[0], self._origin[1] + row * self._stride[1])
+        position = nominal
+        if self._previous is not None:
+            previous_column, previous_row, reference, (x, y) = self._previous
+            expected = ((column - previous_column) * self._stride[0], (row - previous_row) * self._stride[1])
+            (dx, dy), response = register(reference, tile, expected)
+            position = (x + dx, y + dy)
+        height, width = tile.shape[:2]
+        x, y = (min(max(0, position[0]), self._canvas.shape[1] - width),
+                min(max(0, position[1]), self._canvas.shape[0] - height))
+        self._canvas[y:y + height, x:x + width] = tile
+        self._previous = (column, row, tile, (x, y))
+        return x, y
+
+    def close(self):
+        self._canvas.flush()
+        del self._canvas
+
+    @property
+    def path(self):
+        return self._path
+
+
+def build_pyramid(path, directory, tile=256, quality=90):
+    """Cuts the mosaic stored at path into JPEG tiles, one directory per level, halving until one tile is left.
+
+    Level 0 is full resolution and tiles are named <row>_<column>.jpg. Each level is downsampled from the one
+    before in strips into a temporary memory map, so the whole mosaic is never loaded. Returns the level count.
+    """
+    level = 0
+    image = np.load(path, mmap_mode='r')
+    while True:
+        level_dir = os.path.join(directory, str(level))
+        os.makedirs(level_dir, exist_ok=True)
+        for y in range(0, image.shape[0], tile):
+            for x in range(0, image.shape[1], tile):
+                cv2.imwrite(os.path.join(level_dir, '{}_{}.jpg'.format(y // tile, x // tile)),
+                            np.ascontiguousarray(image[y:y + tile, x:x + tile]),
+                            [int(cv2.IMWRITE_JPEG_QUALITY), quality])
+        level += 1
+        if max(image.shape[:2]) <= tile:
+            break
+        smaller_path = os.path.join(directory, 'level{}.npy'.format(level))
+        smaller = np.lib.format.open_memmap(smaller_path, mode='w+', dtype=np.uint8,
+                                            shape=((image.shape[0] + 1) // 2, (image.shape[1] + 1) // 2) +
+                                            image.shape[2:])
+        for y in range(0, image.shape[0], 2 * tile):
+            top = max(0, y - PYRAMID_MARGIN)  # Strips overlap, so no row is blurred against a reflected strip edge
+            strip = cv2.pyrDown(np.ascontiguousarray(image[top:y + 2 * tile + PYRAMID_MARGIN]))
+            strip = strip[(y - top) // 2:(y - top) // 2 + tile]
+            smaller[y // 2:y // 2 + strip.shape[0]] = strip.reshape((strip.shape[0], -1) + image.shape[2:])
+        smaller.flush()
+        if level > 1:
+            os.remove(image.filename)
+        del image
+        image = np.load(smaller_path, mmap_mode='r')
+    if level > 1:
+        os.remove(image.filename)
+    return level
@@ -1,28 +1,89 @@
 import base64
+import json
 import re
+import selectors
+import struct
 
 import cv2
 import logging
 import queue
 import socket
 import threading
+import time
+
+import commands
+from latency import LatencyStats
+from telemetry import Subscription
+
+# Wire formats selected by the client during the name handshake ("<name>;v2")
+PROTOCOL_LEGACY = 1  # 8 ASCII digits of length followed by a base64 JPEG
+PROTOCOL_V2 = 2  # Fixed binary header followed by raw JPEG bytes
+
+FRAME_MAGIC = b'AUTM'
+CODEC_JPEG = 1
+CODEC_JSON = 2  # Replies such as the stats command, sequence 0
+
+# magic, version, sequence, capture timestamp, payload length, codec id
+FRAME_HEADER = struct.Struct('!4sBIdIB')
+
+MAX_COMMAND_SIZE = 4096  # Longest command line a client may send before its input is discarded
+STATS_INTERVAL = 5  # Seconds between per-client throughput log lines
+DROP_RATIO = 0.2  # Share of dropped frames in a one second window that moves a client to a lighter profile
+STABLE_WINDOWS = 5  # Drop free windows before a client is moved back to a better profile
+MAX_BUFFERS = 1024  # IOV_MAX on Linux, sendmsg fails with EMSGSIZE when given more buffers
+
+
+def send_buffers(conn, buffers):
+    """Writes all buffers with as few syscalls as possible (one sendmsg in the common case)."""
+    if not hasattr(conn, 'sendmsg'):  # Platforms without scatter-gather support
+        for buffer in buffers:
+            conn.sendall(buffer)
+        return
+    while buffers:
+        advance_buffers(buffers, conn.sendmsg(buffers[:MAX_BUFFERS]))
+
+
+def advance_buffers(buffers, sent):
+    """Drops the first sent bytes from a list of memoryviews in place. Slicing a memoryview never copies."""
+    while buffers and sent >= buffers[0].nbytes:
+        sent -= buffers.pop(0).nbytes
+    if sent:
+        buffers[0] = buffers[0][sent:]
 
 
 class VideoServer:
-    def __init__(self, ip, port):
-        self._clients = {object: {'conn': object, 'addr': None, 'name': 'Hello'}}
+    _LOG_FILE = "logs/video_server.log"
+    _NODELAY = False  # Frames are sent in one sendmsg, so Nagle's algorithm costs them nothing
+    _STAGE = ''  # Prefix of the latency stages this server records, servers on one frame bus keep theirs apart
+
+    def __init__(self, ip, port, profiles=1):
+        self._clients = {}
+        self._handshakes = {}  # Accepted sockets still waiting for the client name
         self._max_clients = 20
+        self._profiles = profiles  # Number of encode profiles, 0 being the best quality
+        self._stats_time = time.monotonic()
+        self._stats_logged = self._stats_time
+        self._latency = LatencyStats()
         self.latest_connection = None
         self._is_listening = False
+        self._posted = queue.Queue()  # (client name, message) sent from other threads through post()
+        self.telemetry = None  # Telemetry offered to clients that subscribe, set once the instrument is up
 
-        self.logger = logging.getLogger(str(VideoServer))
+        self.logger = logging.getLogger(str(self.__class__))
         self.logger.setLevel(logging.DEBUG)
-        handler = logging.FileHandler("logs/video_server.log")
+        handler = logging.FileHandler(self._LOG_FILE)
         handler.setFormatter(logging.Formatter('%(asctime)s:%(levelname)s:%(funcName)s:line-%(lineno)d->%(message)s'))
         self.logger.addHandler(handler)
 
         self._address = (ip, port)
         self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._selector = selectors.DefaultSelector()
+
+        # Any thread can interrupt a blocking poll() by writing to this pair, e.g. when a new frame is published
+        self._wakeup_receiver, self._wakeup_sender = socket.socketpair()
+        self._wakeup_receiver.setblocking(False)
+        self._wakeup_sender.setblocking(False)
+        self._selector.register(self._wakeup_receiver, selectors.EVENT_READ)
 
     def start(self):
         self.logger.debug("Starting Video Server.")
@@ -32,7 +93,10 @@ class VideoServer:
                 try:
                     self.logger.debug("Binding address {}:{}".format(self.address[0], self.address[1]))
                     self._socket.bind(self._address)
+                    self._address = self._socket.getsockname()[:2]  # Resolves port 0 to the one actually bound
                     self._socket.listen(self._max_clients)
+                    self._socket.setblocking(False)
+                    self._selector.register(self._socket, selectors.EVENT_READ)
                     self._is_listening = True
                     self.logger.debug('Server is now listening')
                 except socket.error:
@@ -49,6 +113,7 @@ class VideoServer:
     def stop(self):
         if self._is_listening:
             self.logger.debug("Closing server socket.")
+            self._selector.unregister(self._socket)
             self._socket.close()
             self._is_listening = False
             self.logger.debug("Server socket closed.")
@@ -63,31 +128,359 @@ class VideoServer:
         self.start()
         print('Resetted')
 
-    def accept_connection(self):
-        self.logger.debug("Waiting for connection at {}:{}".format(self.address[0], self.address[1]))
-        conn, addr = self._socket.accept()
-        self.logger.debug("Connection accepted at {}:{}".format(self.address[0], self.address[1]))
-        self.logger.debug("Receiving client name.")
-        name = conn.recv(32).decode('utf-8')  # Get name of client
-        name = re.sub(r'alive$', '', name)
-        for client in self._clients:
-            if self._clients[client]['name'] == name:
-                self.logger.debug("accept_connection: Client already exists.")
-                return
-        self.logger.debug("Client name:{name} received.".format(name=name))
-        self._clients[conn] = {'conn': conn, 'addr': addr, 'name': name}
+    def serve(self, frame_bus, handle_event=None):
+        """Streams frames from the bus to every client until the server stops listening.
+
+        handle_event, when given, is called with each event returned by poll().
+        """
+        frame_bus.add_listener(self.wakeup)  # New frames interrupt the wait in poll()
+        self._latency = frame_bus.latency
+        last_seq = 0
+        while self._is_listening:
+            frame = frame_bus.latest()
+            if frame is not None and frame.seq != last_seq:
+                last_seq = frame.seq
+                self.queue_frame(frame)
+            for event in self.poll(timeout=1):
+                if handle_event is not None:
+                    handle_event(event)
+
+    def poll(self, timeout=None):
+        """Runs one pass of the event loop over the listening socket and every client.
+
+        Returns a list of events for the caller: ('accepted', conn), ('command', conn, name, (request_id, command,
+        value)) and ('disconnected', conn, name). Clients are removed from the server before their disconnect is
+        reported.
+        """
+        events = []
+        for key, mask in self._selector.select(self._telemetry_timeout(timeout)):
+            conn = key.fileobj
+            if conn is self._socket:
+                self._accept_connection()
+            elif conn is self._wakeup_receiver:
+                self._drain_wakeup()
+            elif conn in self._handshakes:
+                self._receive_handshake(conn, events)
+            elif conn in self._clients:
+                if mask & selectors.EVENT_READ:
+                    self._receive_command(conn, events)
+                if mask & selectors.EVENT_WRITE and conn in self._clients:
+                    self._flush(conn, events)
+        self._send_posted()
+        self._send_telemetry()
+        if time.monotonic() - self._stats_time >= 1:
+            self._update_stats()
+        return events
+
+    def wakeup(self):
+        """Makes a pending poll() return immediately. Safe to call from any thread."""
+        try:
+            self._wakeup_sender.send(b'\0')
+        except (BlockingIOError, OSError):
+            pass  # A wakeup is already pending
+
+    def post(self, name, message):
+        """Sends a JSON message to the client called name, e.g. a completion event. Safe to call from any thread."""
+        self._posted.put((name, message))
+        self.wakeup()
+
+    def _send_posted(self):
+        while not self._posted.empty():
+            name, message = self._posted.get()
+            for conn, client in self._clients.items():
+                if client['name'] == name:
+                    self.send_message(conn, message)
+                    break
+
+    def _send_telemetry(self):
+        now = time.monotonic()
+        snapshot = None  # Read once per pass, shared by every client that is due
+        for conn, client in list(self._clients.items()):
+            subscription = client.get('telemetry')
+            if subscription is None or now < subscription.due:
+                continue
+            if snapshot is None:
+                snapshot = self.telemetry.snapshot()
+            message = subscription.update(snapshot, now)
+            if message is not None:
+                self.send_message(conn, message)
+
+    def _telemetry_timeout(self, timeout):
+        """Shortens the select() timeout so the next telemetry update goes out on time."""
+        due = [client['telemetry'].due for client in self._clients.values() if client.get('telemetry')]
+        if not due:
+            return timeout
+        wait = max(0, min(due) - time.monotonic())
+        return wait if timeout is None else min(timeout, wait)
+
+    def _drain_wakeup(self):
+        try:
+            while self._wakeup_receiver.recv(1024):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+
+    def _accept_connection(self):
+        try:
+            conn, addr = self._socket.accept()
+        except BlockingIOError:
+            return
+        self.logger.debug("Connection accepted at {}:{}".format(addr[0], addr[1]))
+        conn.setblocking(False)
+        if self._NODELAY:
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._handshakes[conn] = addr
+        self._selector.register(conn, selectors.EVENT_READ)
+
+    def _receive_handshake(self, conn, events):
+        addr = self._handshakes.pop(conn)
+        try:
+            data = conn.recv(MAX_COMMAND_SIZE)  # Name of the client, possibly followed by its first commands
+        except (BlockingIOError, InterruptedError):
+            self._handshakes[conn] = addr
+            return
+        except socket.error:
+            data = b''
+        name, protocol, rest = self._parse_handshake(data.decode('utf-8', 'replace'))
+        if not name or any(client['name'] == name for client in self._clients.values()):
+            self.logger.debug("Handshake rejected: Client name '{0}' is empty or already exists.".format(name))
+            self._selector.unregister(conn)
+            conn.close()
+            return
+        self.logger.debug("Client name:{name} received. Protocol: v{protocol}".format(name=name, protocol=protocol))
+        self.add_client(conn, addr, name, protocol)
+        events.append(('accepted', conn))
+        if rest:
+            self._read_commands(conn, rest.encode('utf-8'), events)
+
+    def add_client(self, conn, addr, name, protocol=PROTOCOL_LEGACY):
+        header = bytearray(FRAME_HEADER.size if protocol == PROTOCOL_V2 else 8)  # Reused for every frame
+        self._clients[conn] = {'conn': conn, 'addr': addr, 'name': name, 'protocol': protocol, 'header': header,
+                               'inbox': bytearray(), 'lines': protocol == PROTOCOL_V2, 'outbox': [], 'mailbox': None,
+                               'timestamp': None, 'frame_bytes': 0, 'profile': 0, 'stable': 0,
+                               'stats': {'sent': 0, 'dropped': 0, 'bytes': 0, 'bytes_per_sec': 0.0, 'fps': 0.0,
+                                         'profile': 0, '_sent': 0, '_dropped': 0, '_bytes': 0}}
         self.latest_connection = conn
-        return conn, addr
+
+    def _receive_command(self, conn, events):
+        """Reads newline delimited commands, so commands split across or merged into TCP segments stay intact.
+
+        Old clients send one bare text command per write without a newline: until a client sent its first newline,
+        input that has no newline and is not JSON is taken as one command, as before. v2 clients always end lines.
+        """
+        try:
+            data = conn.recv(MAX_COMMAND_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except socket.error:
+            data = b''
+        if not data:
+            self._remove_client(conn, events)
+            return
+        self._read_commands(conn, data, events)
+
+    def _read_commands(self, conn, data, events):
+        client = self._clients[conn]
+        inbox = client['inbox']
+        inbox.extend(data)
+        if b'\n' in data:
+            client['lines'] = True  # From now on a command without its newline is only partly received
+        if not client['lines'] and not inbox.startswith(b'{'):
+            lines, rest = [bytes(inbox)], b''
+        else:
+            lines = inbox.split(b'\n')
+            rest = lines.pop()
+        if len(rest) > MAX_COMMAND_SIZE:
+            self.logger.debug("Client {0} sent an oversized command -> Input discarded.".format(client['name']))
+            rest = b''
+        inbox[:] = rest
+        for line in lines:
+            self._handle_command(conn, client, line.decode('utf-8', 'replace').strip(), events)
+
+    def _handle_command(self, conn, client, line, events):
+        if not line:
+            return
+        try:
+            request_id, command, value = commands.decode(line)
+        except commands.CommandRejected as e:
+            self.send_message(conn, {'type': 'error', 'id': e.request_id, 'error': str(e)})
+            return
+        if command == 'stats':
+            reply = self.stats()
+            if request_id is not None:
+                reply.update({'type': 'stats', 'id': request_id})
+            self.send_message(conn, reply)
+        elif command in ('subscribe', 'unsubscribe'):
+            self._subscribe(conn, client, request_id, command, value)
+        elif command != 'alive':
+            events.append(('command', conn, client['name'], (request_id, command, value)))
+            if request_id is not None:  # Queued, the completion event follows once the command ran
+                self.send_message(conn, {'type': 'ack', 'id': request_id, 'command': command})
+
+    def _subscribe(self, conn, client, request_id, command, value):
+        """Starts or stops pushing telemetry to a client, value being the updates per second it asks for."""
+        if command == 'unsubscribe':
+            client.pop('telemetry', None)
+            reply = {'type': 'ack', 'id': request_id, 'command': command}
+        elif self.telemetry is None or not self._accepts_messages(client):
+            reply = {'type': 'error', 'id': request_id, 'error': 'Telemetry needs the v2 protocol or a control session.'}
+        else:
+            interval = self.telemetry.interval(value)
+            client['telemetry'] = Subscription(interval)
+            reply = {'type': 'ack', 'id': request_id, 'command': command, 'rate': round(1 / interval, 3)}
+        if request_id is not None or reply['type'] == 'error':
+            self.send_message(conn, reply)
+
+    @staticmethod
+    def _accepts_messages(client):
+        return client['protocol'] == PROTOCOL_V2
+
+    def queue_frame(self, frame):
+        """Hands a new frame to every client.
+
+        A client still busy sending gets the frame in its one-slot mailbox instead, replacing (and counting as
+        dropped) any older frame waiting there. A slow link therefore only ever lags by one frame.
+        """
+        self._latency.record(self._STAGE + 'enqueue', time.time() - frame.timestamp)
+        for conn, client in self._clients.items():
+            if client['outbox']:
+                if client['mailbox'] is not None:
+                    client['stats']['dropped'] += 1
+                client['mailbox'] = frame
+                continue
+            self._start_frame(conn, client, frame)
+
+    def _start_frame(self, conn, client, frame):
+        client['outbox'] = self._frame_buffers(client, frame)
+        if client['outbox']:
+            client['timestamp'] = frame.timestamp
+            client['frame_bytes'] = sum(buffer.nbytes for buffer in client['outbox'])  # Replies may queue behind
+            self._selector.modify(conn, selectors.EVENT_READ | selectors.EVENT_WRITE)
+
+    def _flush(self, conn, events):
+        client = self._clients[conn]
+        outbox = client['outbox']
+        try:
+            sent = conn.sendmsg(outbox[:MAX_BUFFERS])  # Many queued replies may outnumber IOV_MAX
+        except (BlockingIOError, InterruptedError):
+            return
+        except socket.error:
+            self.logger.debug("Unable to send frames -> Client: {client} is currently disconnected".format(client=conn))
+            self._remove_client(conn, events)
+            return
+        client['stats']['bytes'] += sent
+        advance_buffers(outbox, sent)
+        if client['timestamp'] is not None:
+            client['frame_bytes'] -= sent
+            if client['frame_bytes'] <= 0:  # The frame itself went out, whatever replies still follow it
+                client['stats']['sent'] += 1
+                self._latency.record(self._STAGE + 'send', time.time() - client['timestamp'])  # Capture to last byte
+                client['timestamp'] = None
+        if not outbox:
+            if client['mailbox'] is not None:
+                frame, client['mailbox'] = client['mailbox'], None
+                self._start_frame(conn, client, frame)
+            else:
+                self._selector.modify(conn, selectors.EVENT_READ)
+
+    def _update_stats(self):
+        now = time.monotonic()
+        elapsed = now - self._stats_time
+        self._stats_time = now
+        for client in self._clients.values():
+            stats = client['stats']
+            sent, dropped = stats['sent'] - stats['_sent'], stats['dropped'] - stats['_dropped']
+            stats['fps'] = sent / elapsed
+            stats['bytes_per_sec'] = (stats['bytes'] - stats['_bytes']) / elapsed
+            stats['_sent'], stats['_dropped'], stats['_bytes'] = stats['sent'], stats['dropped'], stats['bytes']
+            self._adapt_profile(client, sent, dropped)
+        if now - self._stats_logged >= STATS_INTERVAL:
+            self._stats_logged = now
+            for name, stats in self.client_stats().items():
+                self.logger.debug("Client {name}: {fps:.1f} fps, {bps:.0f} B/s, sent {sent}, dropped {dropped}"
+                                  .format(name=name, fps=stats['fps'], bps=stats['bytes_per_sec'],
+                                          sent=stats['sent'], dropped=stats['dropped']))
+            self.logger.debug("Latency: {0}".format(self._latency))
+
+    def _adapt_profile(self, client, sent, dropped):
+        """Moves a client one rung down the profile ladder when its link drops frames, and back up once stable."""
+        if dropped > max(1, DROP_RATIO * (sent + dropped)):
+            client['stable'] = 0
+            if client['profile'] < self._profiles - 1:
+                client['profile'] += 1
+                self.logger.debug("Client {0} is lagging -> Profile {1}".format(client['name'], client['profile']))
+        else:
+            client['stable'] += 1
+            if client['stable'] >= STABLE_WINDOWS and client['profile'] > 0:
+                client['stable'] = 0
+                client['profile'] -= 1
+                self.logger.debug("Client {0} is stable -> Profile {1}".format(client['name'], client['profile']))
+        client['stats']['profile'] = client['profile']
+
+    def stats(self):
+        """Returns latency percentiles per pipeline stage and the per-client counters."""
+        return {'latency': self._latency.summary(), 'clients': self.client_stats()}
+
+    def send_message(self, conn, message):
+        """Queues a JSON message behind the frame in flight. Only v2 clients can tell it apart from frames."""
+        client = self._clients[conn]
+        if client['protocol'] != PROTOCOL_V2:
+            self.logger.debug("Client {0} uses the legacy protocol -> Message dropped.".format(client['name']))
+            return
+        payload = json.dumps(message).encode('utf-8')
+        header = FRAME_HEADER.pack(FRAME_MAGIC, PROTOCOL_V2, 0, time.time(), len(payload), CODEC_JSON)
+        if not client['outbox']:
+            self._selector.modify(conn, selectors.EVENT_READ | selectors.EVENT_WRITE)
+        client['outbox'].extend((memoryview(header), memoryview(payload)))
+
+    def has_client(self, name):  # Safe from any thread
+        return any(client['name'] == name for client in list(self._clients.values()))
+
+    def client_stats(self):
+        """Returns per-client counters keyed by name: sent and dropped frames, bytes, bytes/s, fps and profile."""
+        return {client['name']: {key: value for key, value in client['stats'].items() if not key.startswith('_')}
+                for client in list(self._clients.values())}
+
+    def _remove_client(self, conn, events):
+        client = self._clients.pop(conn)
+        self.logger.debug("Client disconnected -> Removing Client: {0} at {1}".format(client['addr'], client['name']))
+        self._selector.unregister(conn)
+        conn.close()
+        events.append(('disconnected', conn, client['name']))
+
+    @staticmethod
+    def _parse_handshake(data):
+        """Splits the handshake into the client name, the requested wire format and whatever followed it.
+
+        The handshake is '<name>' or '<name>;v2', optionally ended by a newline. Commands sent right after it can
+        arrive in the same read and are returned as the rest instead of being taken for options.
+        """
+        name, options, rest = re.match(r'([^;\n]*)(?:;(v2)?)?\n?(.*)', data, re.DOTALL).groups()
+        name = re.sub(r'alive$', '', name)
+        protocol = PROTOCOL_V2 if options == 'v2' else PROTOCOL_LEGACY
+        return name, protocol, rest
+
+    @staticmethod
+    def _frame_buffers(client, frame):
+        header = client['header']
+        if client['protocol'] == PROTOCOL_V2:
+            payload = frame.payload(client['profile'])
+            if payload is None:
+                return []
+            payload = memoryview(payload).cast('B')  # Flat view over the encoded numpy buffer, no copy
+            FRAME_HEADER.pack_into(header, 0, FRAME_MAGIC, PROTOCOL_V2, frame.seq & 0xFFFFFFFF, frame.timestamp,
+                                   payload.nbytes, CODEC_JPEG)
+        else:
+            payload = frame.legacy_payload(client['profile'])
+            if payload is None:
+                return []
+            payload = memoryview(payload)
+            header[:] = b'%08d' % payload.nbytes
+        return [memoryview(header), payload]
 
     def send_frame(self, conn, frame):
-        frame_size = len(frame)
-        size = ""
-        if len(str(frame_size)) < 8:
-            size_difference = 8 - len(str(frame_size))
-            size = ("0" * size_difference) + str(frame_size)
         try:
-            conn.sendall(str.encode("{0}".format(size)))
-            conn.sendall(frame)
+            send_buffers(conn, self._frame_buffers(self._clients[conn], frame))
             return True
         except socket.error:
             self.logger.debug("Unable to send frames -> Client: {client} is currently disconnected".format(client=conn))
@@ -102,19 +495,8 @@ class VideoServer:
         self._latest_connection = conn
 
     @property
-    def clients(self):
-        return self._clients
-
-    @clients.setter
-    def clients(self, conn):
-        for client in self._clients:
-            temp_conn = self._clients[client]['conn']
-            if conn == temp_conn:
-                self.logger.debug("Client disconnected -> Removing Client: {0} at {1}"
-                                  .format(self._clients[client]['addr'],  self._clients[client]['name']))
-                self._clients.pop(client)
-                self.logger.debug("Client disconnected -> Client Removed.")
-                return
+    def clients(self):  # Snapshot, the event loop thread owns the live dictionary
+        return dict(self._clients)
 
     @property
     def address(self):
@@ -125,60 +507,180 @@ class VideoServer:
         return self._is_listening
 
 
-class CommunicationServer:
-    def __init__(self, ip, port):
-        self.logger = logging.getLogger(str(CommunicationServer))
-        self.logger.setLevel(logging.DEBUG)
-        handler = logging.FileHandler("comm_server.log")
-        handler.setFormatter(logging.Formatter('%(asctime)s:%(levelname)s:%(funcName)s:line-%(lineno)d->%(message)s'))
-        self.logger.addHandler(handler)
+class MjpegServer(VideoServer):
+    """Motion-JPEG over HTTP for browsers and curl, fed from the same frame bus as the video clients.
 
-        self._is_listening = False;
-        self._address = ip, port
-        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    Every viewer gets a multipart/x-mixed-replace response on any GET request and then one JPEG part per
+    frame. Viewers share the per-profile buffers and get the same mailbox and profile adaptation as video clients.
+    """
+    _LOG_FILE = "logs/mjpeg_server.log"
+    _STAGE = 'mjpeg_'
+    _BOUNDARY = b'frame'
+    _RESPONSE = (b'HTTP/1.0 200 OK\r\n'
+                 b'Cache-Control: no-cache, private\r\n'
+                 b'Pragma: no-cache\r\n'
+                 b'Content-Type: multipart/x-mixed-replace; boundary=' + _BOUNDARY + b'\r\n\r\n')
+    _PART_END = memoryview(b'\r\n')
+    _MAX_REQUEST = 8192
 
-    def start(self):
-        self.logger.debug("Starting Communication Server.")
-        if not self._is_listening:
-            try:
-                self.logger.debug("Binding address {}:{}".format(self._address[0], self._address[1]))
-                self._socket.bind(self._address)
-                self._socket.listen(10)
-                self._is_listening = True
-            except socket.error:
-                self.logger.debug("Unable to use current address...{0}".format(self._address))
-        else:
-            self.logger.debug("Unable to start server -> Server is already started/Not yet started.")
+    def __init__(self, ip, port, profiles=1):
+        VideoServer.__init__(self, ip, port, profiles)
+        self._requests = {}  # Partial HTTP requests by socket
 
-    def stop(self):
-        if self._is_listening:
-            self.logger.debug("Closing server socket.")
-            self._socket.close()
-            self._is_listening = False
-            self.logger.debug("Server socket closed.")
-        else:
-            self.logger.debug("Unable to close server -> Server is already closed.")
+    def _receive_handshake(self, conn, events):
+        try:
+            data = conn.recv(1024)
+        except (BlockingIOError, InterruptedError):
+            return
+        except socket.error:
+            data = b''
+        request = self._requests.get(conn, b'') + data
+        if data and b'\r\n\r\n' not in request and len(request) < self._MAX_REQUEST:
+            self._requests[conn] = request  # Wait for the rest of the headers
+            return
+        addr = self._handshakes.pop(conn)
+        self._requests.pop(conn, None)
+        if not request.startswith(b'GET ') or b'\r\n\r\n' not in request:
+            self.logger.debug("Request rejected from {0}".format(addr))
+            self._selector.unregister(conn)
+            conn.close()
+            return
+        name = 'http:{0}:{1}'.format(addr[0], addr[1])
+        self.logger.debug("Viewer {name} connected.".format(name=name))
+        self.add_client(conn, addr, name)
+        self._clients[conn]['preamble'] = memoryview(self._RESPONSE)
+        events.append(('accepted', conn))
 
-    def accept_connection(self):
-        self.logger.debug("Waiting for connection at {}:{}".format(self._address[0], self._address[1]))
-        conn, addr = self._socket.accept()  # Wait until client connects
-        name = conn.recv(1024).decode('utf-8')  # Get name of client
-        # self.clients[name] = [conn, addr, name, 'false', self.client_id]  # Add the {conn, name, permission} to the clients dictionary
-        self.logger.debug("Connection accepted at {}:{}".format(addr[0], addr[1]))
-        return conn, addr
+    def _receive_command(self, conn, events):  # Browsers send nothing after the request, only watch for close
+        try:
+            data = conn.recv(1024)
+        except (BlockingIOError, InterruptedError):
+            return
+        except socket.error:
+            data = b''
+        if not data:
+            self._remove_client(conn, events)
+
+    def _frame_buffers(self, client, frame):
+        payload = frame.payload(client['profile'])
+        if payload is None:
+            return []
+        payload = memoryview(payload).cast('B')
+        header = b'--%s\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n' % (self._BOUNDARY, payload.nbytes)
+        buffers = [memoryview(header), payload, self._PART_END]
+        if client.get('preamble') is not None:  # HTTP response headers go out with the first part
+            buffers.insert(0, client.pop('preamble'))
+        return buffers
+
+
+class CommunicationServer(VideoServer):
+    """Control channel beside the video stream, so commands and their replies never wait behind a frame send.
+
+    A client connects, sends its name and a newline, then the same command lines it could send on the video
+    socket. Every reply is one JSON line. The session is bound to the video client of the same name: that client
+    must be streaming when the session opens, and close_session() ends it when the video connection goes away.
+    """
+    _LOG_FILE = "logs/comm_server.log"
+    _NODELAY = True  # Replies are a few bytes each and must not wait for the previous one to be acknowledged
+    _CONTROL_NOTE = ('Server side only, from reading a command to its ack being queued. '
+                     'tests/control_latency_benchmark.py measures the round trip.')
+
+    def __init__(self, ip, port, video_server=None, latency=None):
+        """latency is the LatencyStats 'control' is recorded into, normally the one of the frame bus."""
+        VideoServer.__init__(self, ip, port)
+        self._video_server = video_server
+        if latency is not None:
+            self._latency = latency
+        self._closing = queue.Queue()  # Names whose session close_session() ended
+
+    def serve(self, handle_event=None):
+        """Runs the control channel until the server stops listening. There are no frames to send."""
+        while self._is_listening:
+            for event in self.poll(timeout=1):
+                if handle_event is not None:
+                    handle_event(event)
 
-    def receive_command(self, conn):
-        command = conn.recv(1024).decode('utf-8')
-        if command:
-            self.logger.debug('Command received -> '.format(command))
-            return True, command
+    def poll(self, timeout=None):
+        events = VideoServer.poll(self, timeout)
+        while not self._closing.empty():
+            name = self._closing.get()
+            for conn, client in list(self._clients.items()):
+                if client['name'] == name:
+                    self._remove_client(conn, events)
+        return events
+
+    def close_session(self, name):
+        """Ends the session of a client, e.g. once its video connection is gone. Safe to call from any thread."""
+        self._closing.put(name)
+        self.wakeup()
+
+    def _receive_handshake(self, conn, events):
+        addr = self._handshakes.pop(conn)
+        try:
+            data = conn.recv(MAX_COMMAND_SIZE)
+        except (BlockingIOError, InterruptedError):
+            self._handshakes[conn] = addr
+            return
+        except socket.error:
+            data = b''
+        name, _, rest = data.partition(b'\n')  # Commands may follow the name in the same segment
+        name = name.decode('utf-8', 'replace').strip()
+        if not name or self.has_client(name):
+            reason = "Client name '{0}' is empty or already has a session.".format(name)
+        elif self._video_server is not None and not self._video_server.has_client(name):
+            reason = "No video connection named '{0}'.".format(name)
         else:
-            self.logger.debug('No command received.')
-            return False, None
+            reason = None
+        if reason is not None:
+            self.logger.debug("Session rejected: {0}".format(reason))
+            try:
+                conn.send(self._encode({'type': 'error', 'id': None, 'error': reason}))
+            except socket.error:
+                pass
+            self._selector.unregister(conn)
+            conn.close()
+            return
+        self.logger.debug("Session opened for {name}.".format(name=name))
+        self.add_client(conn, addr, name)
+        self._clients[conn]['lines'] = True  # The name already ended with a newline
+        events.append(('accepted', conn))
+        self.send_message(conn, {'type': 'session', 'name': name})
+        if rest:
+            self._read_commands(conn, rest, events)
 
-    @property
-    def address(self):
-        return self._address
+    def _receive_command(self, conn, events):
+        start = time.monotonic()
+        VideoServer._receive_command(self, conn, events)
+        self._latency.record('control', time.monotonic() - start)  # Command read to its ack queued
+
+    def stats(self):
+        """Returns the latency stages, 'control' included, with the video clients of the bound video server."""
+        video_server = self if self._video_server is None else self._video_server
+        return {'latency': self._latency.summary(), 'clients': video_server.client_stats(),
+                'notes': {'control': self._CONTROL_NOTE}}
 
+    def send_message(self, conn, message):
+        """Sends a reply as one JSON line, right away unless older replies are still waiting to go out."""
+        client = self._clients[conn]
+        line = memoryview(self._encode(message))
+        if not client['outbox']:
+            try:
+                sent = conn.send(line)
+            except (BlockingIOError, InterruptedError):
+                sent = 0
+            except socket.error:
+                return  # The next read reports the disconnect
+            client['stats']['bytes'] += sent
+            line = line[sent:]
+            if not line.nbytes:
+                return
+            self._selector.modify(conn, selectors.EVENT_READ | selectors.EVENT_WRITE)
+        client['outbox'].append(line)
 
+    @staticmethod
+    def _accepts_messages(client):
+        return True
 
+    @staticmethod
+    def _encode(message):
+        return (json.dumps(message) + '\n').encode('utf-8')
@@ -0,0 +1,59 @@
+import time
+
+
+def delta(previous, current):
+    """Returns the fields of current that differ from previous, all of them when previous is None.
+
+    A field that disappeared is sent as None.
+    """
+    if previous is None:
+        return dict(current)
+    changes = {key: value for key, value in current.items() if previous.get(key) != value}
+    changes.update((key, None) for key in previous if key not in current)
+    return changes
+
+
+class Telemetry:
+    """Live instrument state pushed to subscribed clients: axis positions, lens, servos and focus.
+
+    Values are pulled from sources, callables returning a dict each, only when a subscription is due. Keeping
+    the values where they already live means nothing is copied while nobody is subscribed. rate is the default
+    number of updates per second, and a client may ask for any rate up to max_rate.
+    """
+
+    def __init__(self, sources, rate=5, max_rate=30):
+        self._sources = list(sources)
+        self._rate = rate
+        self._max_rate = max_rate
+
+    def snapshot(self):
+        values = {}
+        for source in self._sources:
+            values.update(source())
+        return values
+
+    def interval(self, rate=None):
+        """Seconds between two updates for the requested rate, the default one when rate is None."""
+        rate = self._rate if not rate else rate
+        return 1.0 / min(max(rate, 1), self._max_rate)
+
+
+class Subscription:
+    """Telemetry state of one client: when its next update is due and what it was sent last."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.due = time.monotonic()
+        self.values = None
+
+    def update(self, snapshot, now):
+        """Returns the message to send for snapshot, or None when nothing changed since the last one."""
+        self.due = max(self.due + self.interval, now)
+        changes = delta(self.values, snapshot)
+        if not changes:
+            return None
+        message = {'type': 'telemetry', 'time': round(time.time(), 3), 'values': changes}
+        if self.values is None:
+            message['full'] = True  # Every later message only carries what changed
+        self.values = snapshot
+        return message
@@ -0,0 +1,161 @@
+"""Behavior checks of the autofocus search and of command decoding, coalescing and line splitting.
+
+Runs without hardware, camera or network: autofocus measures synthetic focus curves, and commands are fed to
+a VideoServer as if they came off a socket. Prints one line per check and exits with 1 if any failed.
+
+    python tests/behavior_check.py
+"""
+import math
+import os
+import sys
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, BASE_DIR)
+os.makedirs('logs', exist_ok=True)
+
+import commands
+import server
+from autofocus import AutofocusEngine
+
+failures = []
+
+
+def check(name, condition, detail=''):
+    print('{0} {1}{2}'.format('ok  ' if condition else 'FAIL', name, ' ({0})'.format(detail) if detail else ''))
+    if not condition:
+        failures.append(name)
+
+
+class Stage:
+    """Z axis over a focus curve peaking at peak. Records every position a frame was measured at."""
+
+    def __init__(self, peak, width=15.0, position=0):
+        self.peak = peak
+        self.width = width
+        self.position = position
+        self.measured = []
+
+    def move_to(self, position):
+        self.position = position
+
+    def measure(self):
+        self.measured.append(self.position)
+        return 10 + 1000 * math.exp(-((self.position - self.peak) / self.width) ** 2)
+
+
+def autofocus(stage, threshold=None, seed=None, budget=24):
+    engine = AutofocusEngine(stage.move_to, stage.measure, 0, 200, coarse_step=20, budget=budget, tolerance=2)
+    position, focus = engine.run(stage.position, threshold, seed)
+    return engine, position
+
+
+def read_lines(video_server, chunks, protocol=server.PROTOCOL_LEGACY):
+    """Feeds chunks to a new client as consecutive reads, returns the (name, value) of the commands it sent."""
+    conn = object()
+    video_server.add_client(conn, None, 'check', protocol)
+    events = []
+    for chunk in chunks:
+        video_server._read_commands(conn, chunk, events)
+    del video_server._clients[conn]
+    return [event[3][1:] for event in events if event[0] == 'command']
+
+
+# Autofocus peak search
+for peak, start in ((37, 0), (150, 0), (3, 200), (197, 0), (120, 120)):
+    stage = Stage(peak, position=start)
+    engine, position = autofocus(stage)
+    check('autofocus finds peak {0} from {1}'.format(peak, start), abs(position - peak) <= 2,
+          'found {0} in {1} moves'.format(position, engine.moves))
+    check('autofocus stays within budget, peak {0}'.format(peak), engine.moves <= 24)
+    check('autofocus never measures a position twice, peak {0}'.format(peak),
+          len(stage.measured) == len(set(stage.measured)))
+    check('autofocus ends at the best position, peak {0}'.format(peak), stage.position == position)
+
+stage = Stage(80, width=4.0)
+engine, position = autofocus(stage)
+check('autofocus finds a narrow peak', abs(position - 80) <= 2, 'found {0}'.format(position))
+
+stage = Stage(100, position=100)
+engine, position = autofocus(stage, threshold=900)
+check('autofocus skips the search when already sharp', engine.moves == 0 and position == 100)
+
+sweep_engine, sweep_position = autofocus(Stage(143))
+seed_engine, seed_position = autofocus(Stage(143), seed=138)
+check('autofocus seeded search finds the peak', abs(seed_position - 143) <= 2, 'found {0}'.format(seed_position))
+check('autofocus seeded search needs fewer moves', seed_engine.moves < sweep_engine.moves,
+      '{0} vs {1}'.format(seed_engine.moves, sweep_engine.moves))
+
+stage = Stage(150)
+engine, position = autofocus(stage, budget=3)
+check('autofocus stops at its budget', engine.moves <= 3 and stage.measured, 'best so far {0}'.format(position))
+
+stage = Stage(100, width=1e9)
+engine, position = autofocus(stage)
+check('autofocus handles a flat curve', 0 <= position <= 200 and engine.moves <= 24)
+
+# Decoding
+check('decode text', commands.decode('zoom:120') == (None, 'zoom', 120))
+check('decode text without value', commands.decode('up') == (None, 'up', None))
+check('decode JSON', commands.decode('{"id": 7, "command": "zoom", "value": 120}') == (7, 'zoom', 120))
+check('decode JSON without value', commands.decode('{"id": 8, "command": "brightness"}') == (8, 'brightness', None))
+for line, request_id in (('zoom:abc', None), ('{"id": 3, "command": "zoom"', None),
+                         ('{"id": 4, "value": 5}', 4), ('{"id": 5, "command": "zoom", "value": "5"}', 5),
+                         ('{"id": 6, "command": 7}', 6)):
+    try:
+        commands.decode(line)
+        rejected = None
+    except commands.CommandRejected as e:
+        rejected = e
+    check('decode rejects {0}'.format(line), rejected is not None and rejected.request_id == request_id)
+
+# Coalescing
+check('coalesce sums moves of one axis',
+      commands.coalesce([(1, 'up', None), (2, 'up', None), (3, 'down', None), (4, 'up', None)]) ==
+      [('updown', 2, [1, 2, 3, 4])])
+check('coalesce keeps moves that cancel out as 0 steps',
+      commands.coalesce([(1, 'left', None), (2, 'right', None)]) == [('leftright', 0, [1, 2])])
+check('coalesce keeps axes apart',
+      commands.coalesce([(None, 'up', None), (None, 'left', None), (None, 'up', None)]) ==
+      [('updown', 1, []), ('leftright', 1, []), ('updown', 1, [])])
+check('coalesce keeps the last setting and all its ids',
+      commands.coalesce([(1, 'zoom', 10), (2, 'up', None), (3, 'zoom', 90)]) ==
+      [('updown', 1, [2]), ('zoom', 90, [1, 3])])
+check('coalesce keeps a last setting without value',
+      commands.coalesce([(1, 'brightness', 40), (2, 'brightness', None)]) == [('brightness', None, [1, 2])])
+check('coalesce passes other commands through',
+      commands.coalesce([(1, 'autofocus', None), (None, 'autofocus', None)]) ==
+      [('autofocus', None, [1]), ('autofocus', None, [])])
+
+# Line splitting
+video_server = server.VideoServer('127.0.0.1', 0)
+check('legacy write without newline is one command', read_lines(video_server, [b'zoom:5', b'up']) ==
+      [('zoom', 5), ('up', None)])
+check('merged lines are separate commands', read_lines(video_server, [b'zoom:5\nup\n']) == [('zoom', 5), ('up', None)])
+check('split line is one command once newlines were seen',
+      read_lines(video_server, [b'up\n', b'zoo', b'm:5\n']) == [('up', None), ('zoom', 5)])
+check('split JSON line is one command',
+      read_lines(video_server, [b'{"id": 1, "comm', b'and": "up"}\n']) == [('up', None)])
+check('v2 split line is one command',
+      read_lines(video_server, [b'zoo', b'm:5\n'], server.PROTOCOL_V2) == [('zoom', 5)])
+check('handshake keeps the commands sent with it',
+      server.VideoServer._parse_handshake('cam;v2\nup\n') == ('cam', server.PROTOCOL_V2, 'up\n'))
+check('legacy handshake', server.VideoServer._parse_handshake('camalive') == ('cam', server.PROTOCOL_LEGACY, ''))
+
+
+class Socket:  # Accepts everything it is given, but like Linux no more than IOV_MAX buffers per sendmsg
+    def sendmsg(self, buffers):
+        if len(buffers) > 1024:
+            raise OSError('EMSGSIZE')
+        return sum(buffer.nbytes for buffer in buffers)
+
+
+buffers = [memoryview(b'{}\n') for _ in range(3000)]
+try:
+    server.send_buffers(Socket(), buffers)
+    sent = not buffers
+except OSError:
+    sent = False
+check('more buffers than IOV_MAX are sent', sent)
+
+print('{0} checks failed'.format(len(failures)) if failures else 'All checks passed')
+sys.exit(1 if failures else 0)
@@ -0,0 +1,57 @@
+"""Per-step cost of hardware detection across a full lens_motor cycle.
+
+Steps the simulated backend from 0 to the last static lens position and back, once probing the import system
+before every step like the old check_dependency('RPi') did, and once consulting the capability registry.
+
+    python tests/capability_overhead_benchmark.py [--repeat 3]
+"""
+import argparse
+import importlib
+import importlib.util
+import json
+import os
+import sys
+import time
+import warnings
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+import hardware
+
+
+def probe_import(dependency):  # What check_dependency did, find_loader is gone from newer Pythons
+    finder = getattr(importlib, 'find_loader', None) or importlib.util.find_spec
+    return finder(dependency) is not None
+
+
+def cycle(backend, pin, positions, detect):
+    start = time.perf_counter()
+    for position in positions:
+        if detect():
+            pass
+        backend.output(pin, hardware.HIGH)
+        backend.output(pin, hardware.LOW)
+    return time.perf_counter() - start
+
+
+warnings.simplefilter('ignore', DeprecationWarning)
+parser = argparse.ArgumentParser(description='Per-step cost of hardware detection.')
+parser.add_argument('--repeat', type=int, default=3)
+args = parser.parse_args()
+
+with open(os.path.join(BASE_DIR, 'settings.json')) as file:
+    lens = json.load(file)['lens_motor']
+last = lens['position']['static'][-1]
+positions = list(range(0, last)) + list(range(last, 0, -1))  # 0 -> 4267 -> 0, one step each
+backend = hardware.SimulatedBackend(history_size=1)
+pin = lens['pins']['step']
+
+baseline = min(cycle(backend, pin, positions, lambda: False) for i in range(args.repeat))
+for name, detect in (('importlib per step', lambda: probe_import('RPi')),
+                     ('capability registry', lambda: hardware.has('gpio'))):
+    elapsed = min(cycle(backend, pin, positions, detect) for i in range(args.repeat))
+    print('{name:>20}: {steps} steps in {total:7.1f} ms | detection overhead {overhead:6.2f} us/step,'
+          ' {cycle:7.1f} ms/cycle'.format(name=name, steps=len(positions), total=elapsed * 1000,
+                                          overhead=(elapsed - baseline) / len(positions) * 1e6,
+                                          cycle=(elapsed - baseline) * 1000))
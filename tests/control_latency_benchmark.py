@@ -0,0 +1,115 @@
+"""Command round trip on the control channel versus the video socket, under video load.
+
+Starts a VideoServer streaming large frames and a CommunicationServer bound to it. One client streams video
+while reading slowly, so its socket is always backed up. The client pings with JSON commands on both channels
+and times each ack. On the video socket the ack waits behind the frame in flight, on the control channel it does not.
+
+    python tests/control_latency_benchmark.py [--pings 200] [--frame-size 400000] [--read-rate 4000000]
+"""
+import argparse
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, BASE_DIR)
+os.makedirs('logs', exist_ok=True)
+
+import server
+from framebus import FrameBus
+from latency import LatencyStats
+
+parser = argparse.ArgumentParser(description='Control channel latency under video load.')
+parser.add_argument('--pings', type=int, default=200)
+parser.add_argument('--frame-size', type=int, default=400000, help='Bytes per published frame.')
+parser.add_argument('--fps', type=float, default=30)
+parser.add_argument('--read-rate', type=float, default=4e6, help='Bytes/s the video client reads.')
+args = parser.parse_args()
+
+
+def publish(frame_bus, stop):
+    payload = os.urandom(args.frame_size)
+    while not stop.is_set():
+        frame_bus.publish({0: payload})
+        time.sleep(1.0 / args.fps)
+
+
+def read_video(conn, acks, stop):
+    """Reads the v2 stream at read_rate, setting the event of every ack found between the frames."""
+    buffer = b''
+    header = server.FRAME_HEADER
+    chunk = int(args.read_rate / 100)
+    while not stop.is_set():
+        try:
+            data = conn.recv(chunk)
+        except OSError:
+            return
+        if not data:
+            return
+        buffer += data
+        while len(buffer) >= header.size:
+            magic, version, seq, timestamp, size, codec = header.unpack_from(buffer)
+            if len(buffer) < header.size + size:
+                break
+            if codec == server.CODEC_JSON:
+                message = json.loads(buffer[header.size:header.size + size].decode('utf-8'))
+                if message.get('type') == 'ack':
+                    acks[message['id']].set()
+            buffer = buffer[header.size + size:]
+        time.sleep(0.01)
+
+
+def read_control(conn, acks, stop):
+    reader = conn.makefile('r')
+    for line in reader:
+        message = json.loads(line)
+        if message.get('type') == 'ack':
+            acks[message['id']].set()
+        if stop.is_set():
+            return
+
+
+frame_bus = FrameBus()
+video_server = server.VideoServer('127.0.0.1', 0)
+video_server.start()
+comm_server = server.CommunicationServer('127.0.0.1', 0, video_server, frame_bus.latency)
+comm_server.start()
+stop = threading.Event()
+threading.Thread(target=video_server.serve, args=(frame_bus,), daemon=True).start()
+threading.Thread(target=comm_server.serve, daemon=True).start()
+threading.Thread(target=publish, args=(frame_bus, stop), daemon=True).start()
+
+video = socket.create_connection(video_server.address)
+video.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 65536)
+video.sendall(b'bench;v2')
+time.sleep(0.5)
+control = socket.create_connection(comm_server.address)
+control.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+control.sendall(b'bench\n')
+
+acks = {}
+for request_id in range(2 * args.pings):
+    acks[request_id] = threading.Event()
+threading.Thread(target=read_video, args=(video, acks, stop), daemon=True).start()
+threading.Thread(target=read_control, args=(control, acks, stop), daemon=True).start()
+time.sleep(1)  # Let the video socket back up
+
+latency = LatencyStats(size=args.pings)
+for index in range(args.pings):
+    for channel, conn, request_id in (('control', control, 2 * index), ('video', video, 2 * index + 1)):
+        start = time.monotonic()
+        conn.sendall((json.dumps({'id': request_id, 'command': 'ping'}) + '\n').encode('utf-8'))
+        if acks[request_id].wait(5):
+            latency.record(channel, time.monotonic() - start)
+        else:
+            print('{0}: ack {1} timed out'.format(channel, request_id))
+
+stop.set()
+print('{pings} pings, {size} byte frames at {fps:.0f} fps, video read at {rate:.1f} MB/s'.format(
+    pings=args.pings, size=args.frame_size, fps=args.fps, rate=args.read_rate / 1e6))
+print('round trip: {}'.format(latency))
+print('server side: {}'.format(comm_server.stats()['latency']['control']))
+os._exit(0)
@@ -0,0 +1,183 @@
+"""Camera to network throughput benchmark.
+
+Runs Camera, CameraThread and VideoServer on a synthetic (or video file) source and attaches simulated loopback
+clients speaking the v2 or legacy protocol. Reports fps, bytes/s, CPU% and latency percentiles per client count.
+
+    python tests/pipeline_benchmark.py [--source video.avi] [--clients 1 5 20] [--seconds 10] [--legacy]
+"""
+import argparse
+import json
+import os
+import resource
+import socket
+import sys
+import threading
+import time
+
+import cv2
+import numpy as np
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, BASE_DIR)
+os.makedirs('logs', exist_ok=True)
+
+import server
+from automi import Camera, CameraThread
+from latency import LatencyStats
+
+
+class SyntheticCapture:
+    """Stands in for cv2.VideoCapture: a moving gradient with noise, delivered at a fixed sensor rate."""
+
+    def __init__(self, fps=30, size=(640, 480)):
+        self._interval = 1.0 / fps
+        self._deadline = time.monotonic()
+        self._opened = True
+        width, height = size
+        self._base = np.tile(np.linspace(0, 255, width, dtype=np.uint8), (height, 1))
+        self._noise = np.random.randint(0, 32, (height, width), dtype=np.uint8)
+        self._index = 0
+
+    def read(self, image=None):
+        delay = self._deadline - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        self._deadline = max(self._deadline + self._interval, time.monotonic())
+        self._index += 1
+        gray = np.roll(self._base, self._index * 4, axis=1) + self._noise
+        if image is None:
+            image = np.empty(gray.shape + (3,), dtype=np.uint8)
+        image[...] = gray[..., None]
+        return True, image
+
+    def isOpened(self):
+        return self._opened
+
+    def release(self):
+        self._opened = False
+
+
+class FileCapture:
+    """Loops a video file forever at the given rate."""
+
+    def __init__(self, path, fps=30):
+        self._path = path
+        self._capture = cv2.VideoCapture(path)
+        self._interval = 1.0 / fps
+        self._deadline = time.monotonic()
+
+    def read(self, image=None):
+        delay = self._deadline - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        self._deadline = max(self._deadline + self._interval, time.monotonic())
+        ok, frame = self._capture.read(image)
+        if not ok:
+            self._capture.release()
+            self._capture = cv2.VideoCapture(self._path)
+            ok, frame = self._capture.read(image)
+        return ok, frame
+
+    def isOpened(self):
+        return self._capture.isOpened()
+
+    def release(self):
+        self._capture.release()
+
+
+def receive_exactly(conn, view):
+    while view.nbytes:
+        received = conn.recv_into(view)
+        if not received:
+            raise ConnectionError
+        view = view[received:]
+
+
+def run_client(port, name, legacy, stop, result):
+    conn = socket.create_connection(('127.0.0.1', port))
+    conn.settimeout(1)  # The server leaves client sockets open when it stops
+    conn.sendall(name.encode() if legacy else (name + ';v2').encode())
+    header = bytearray(8 if legacy else server.FRAME_HEADER.size)
+    payload = bytearray(1 << 22)
+    latency = LatencyStats(size=100000)
+    frames = received = 0
+    try:
+        while not stop.is_set():
+            receive_exactly(conn, memoryview(header))
+            if legacy:
+                size, timestamp, codec = int(header), None, server.CODEC_JPEG
+            else:
+                magic, version, seq, timestamp, size, codec = server.FRAME_HEADER.unpack(header)
+            receive_exactly(conn, memoryview(payload)[:size])
+            if codec != server.CODEC_JPEG:
+                continue
+            frames += 1
+            received += len(header) + size
+            if timestamp is not None:
+                latency.record('end_to_end', time.time() - timestamp)
+    except (ConnectionError, OSError):
+        pass
+    finally:
+        conn.close()
+    result.update(frames=frames, bytes=received, latency=latency.percentiles('end_to_end'))
+
+
+def run(capture, client_count, seconds, legacy, settings):
+    camera = Camera(0, settings['server']['profiles'], settings['camera']['fps'])
+    camera.start(capture)
+    camera_thread = CameraThread(camera)
+    threading.Thread(target=camera_thread.run, daemon=True).start()
+
+    video_server = server.VideoServer('127.0.0.1', 0, len(settings['server']['profiles']))
+    video_server.start()
+    port = video_server.address[1]
+    threading.Thread(target=video_server.serve, args=(camera.frame_bus,), daemon=True).start()
+
+    stop = threading.Event()
+    results = [{} for i in range(client_count)]
+    clients = [threading.Thread(target=run_client, args=(port, 'bench{}'.format(i), legacy, stop, results[i]))
+               for i in range(client_count)]
+    for client in clients:
+        client.start()
+
+    time.sleep(1)  # Let clients connect and the encoder pick up their profiles
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.monotonic()
+    time.sleep(seconds)
+    elapsed = time.monotonic() - start
+    cpu = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = (cpu.ru_utime - usage.ru_utime + cpu.ru_stime - usage.ru_stime) / elapsed * 100
+
+    stop.set()
+    video_server.stop()
+    camera.stop()
+    for client in clients:
+        client.join()
+
+    # Clients include the warm up second, so rates use the wall time of both phases
+    total = elapsed + 1
+    fps = [result['frames'] / total for result in results]
+    rates = [result['bytes'] / total for result in results]
+    p50 = [result['latency']['p50'] for result in results if result['latency']]
+    p99 = [result['latency']['p99'] for result in results if result['latency']]
+    print('{clients:>3} clients | fps/client {fps:6.1f} (min {fps_min:5.1f}) | {mbps:7.2f} MB/s total | CPU {cpu:5.1f}% |'
+          ' latency p50 {p50:6.1f} ms p99 {p99:6.1f} ms'.format(
+              clients=client_count, fps=sum(fps) / len(fps), fps_min=min(fps), mbps=sum(rates) / 1e6, cpu=cpu,
+              p50=max(p50) if p50 else float('nan'), p99=max(p99) if p99 else float('nan')))
+    print('          stages: {}'.format(camera.frame_bus.latency))
+
+
+parser = argparse.ArgumentParser(description='Camera to network pipeline benchmark.')
+parser.add_argument('--source', help='Video file to loop instead of the synthetic camera.')
+parser.add_argument('--clients', type=int, nargs='+', default=[1, 5, 20])
+parser.add_argument('--seconds', type=float, default=10)
+parser.add_argument('--sensor-fps', type=float, default=30)
+parser.add_argument('--legacy', action='store_true', help='Clients speak the base64 protocol instead of v2.')
+args = parser.parse_args()
+
+with open(os.path.join(BASE_DIR, 'settings.json')) as file:
+    settings = json.load(file)
+
+for count in args.clients:
+    source = FileCapture(args.source, args.sensor_fps) if args.source else SyntheticCapture(args.sensor_fps)
+    run(source, count, args.seconds, args.legacy, settings)
@@ -0,0 +1,99 @@
+import base64
+import os
+import socket
+import sys
+import threading
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+os.makedirs('logs', exist_ok=True)
+
+import server
+from framebus import FrameBus
+
+FRAMES = 2000
+
+
+class CountingSocket:
+    """Wraps a socket and counts the send calls made on it."""
+
+    def __init__(self, sock):
+        self._sock = sock
+        self.calls = 0
+
+    def sendall(self, data):
+        self.calls += 1
+        return self._sock.sendall(data)
+
+    def sendmsg(self, buffers):
+        self.calls += 1
+        return self._sock.sendmsg(buffers)
+
+
+def drain(sock):
+    buffer = bytearray(1 << 20)  # Preallocated so the reader does not show up in the allocation numbers
+    while sock.recv_into(buffer):
+        pass
+
+
+def legacy_send_frame(conn, buffer):  # Send path before the v2 protocol, kept here for comparison
+    frame = base64.b64encode(buffer)
+    frame_size = len(frame)
+    size = ""
+    if len(str(frame_size)) < 8:
+        size_difference = 8 - len(str(frame_size))
+        size = ("0" * size_difference) + str(frame_size)
+    conn.sendall(str.encode("{0}".format(size)))
+    conn.sendall(frame)
+
+
+def measure(name, send):
+    writer, reader = socket.socketpair()
+    drainer = threading.Thread(target=drain, args=(reader,))
+    drainer.start()
+    counting = CountingSocket(writer)
+
+    send(counting)  # Warm up lazily created buffers
+    counting.calls = 0
+    tracemalloc.start()
+    baseline, _ = tracemalloc.get_traced_memory()
+    start = time.perf_counter()
+    for i in range(FRAMES):
+        send(counting)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    writer.close()
+    drainer.join()
+    reader.close()
+    print('{name:<26} {us:8.1f} us/frame {calls:6.2f} syscalls/frame {copied:9d} bytes peak copy'.format(
+        name=name, us=elapsed / FRAMES * 1e6, calls=counting.calls / FRAMES, copied=peak - baseline))
+
+
+frame = np.random.randint(0, 255, (480, 640, 3), dtype=np.uint8)
+frame = cv2.GaussianBlur(frame, (15, 15), 0)
+retval, buffer = cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), 40])
+print('Encoded frame size: {} bytes, {} frames per run'.format(len(buffer), FRAMES))
+
+bus = FrameBus()
+
+video_server = server.VideoServer('', 0)
+
+
+def send_with(protocol):
+    def send(conn):
+        if conn not in video_server.clients:
+            video_server.add_client(conn, None, 'bench', protocol)
+        bus.publish({0: buffer})  # A new frame every time, as the camera would publish it
+        video_server.send_frame(conn, bus.latest())
+    return send
+
+
+measure('before (base64+sendall)', lambda conn: legacy_send_frame(conn, buffer))
+measure('legacy (sendmsg)', send_with(server.PROTOCOL_LEGACY))
+measure('v2 (sendmsg)', send_with(server.PROTOCOL_V2))
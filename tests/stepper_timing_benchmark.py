@@ -0,0 +1,50 @@
+"""Stepper timing on the simulated backend.
+
+Runs the lens motor settings through full moves on SimulatedBackend and checks the recorded step edges: modelled
+position, move duration, step rate and the shortest interval between two steps against the ramp table.
+
+    python tests/stepper_timing_benchmark.py [--steps 4267]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+import hardware
+from motor import Stepper
+
+parser = argparse.ArgumentParser(description='Stepper timing on the simulated backend.')
+parser.add_argument('--steps', type=int, default=4267)
+args = parser.parse_args()
+
+with open(os.path.join(BASE_DIR, 'settings.json')) as file:
+    pins = json.load(file)['lens_motor']['pins']
+
+backend = hardware.SimulatedBackend(history_size=4 * args.steps)
+stepper = Stepper(backend=backend, **pins)
+step_pin = pins['step']
+
+for direction in ('cw', 'ccw'):
+    backend.edges.clear()
+    start = time.monotonic()
+    move = stepper.move(direction, args.steps)
+    queued = time.monotonic() - start
+    move.wait()
+    elapsed = time.monotonic() - start
+    rising = [edge[0] for edge in backend.edges if edge[1] == step_pin and edge[2] == hardware.HIGH]
+    intervals = [later - earlier for earlier, later in zip(rising, rising[1:])]
+    shortest = min(min(move.intervals[1:]), min(move.intervals[:-1]))
+    print('{direction:>3}: {steps} steps in {elapsed:.2f}s ({rate:.0f} steps/s, move() returned in {queued:.1f} ms) |'
+          ' position {position} | shortest interval {actual:.3f} ms (table {table:.3f} ms)'.format(
+              direction=direction, steps=len(rising), elapsed=elapsed, rate=len(rising) / elapsed,
+              queued=queued * 1000, position=backend.position(step_pin, forward=Stepper._CW),
+              actual=min(intervals) * 1000, table=shortest * 1000))
+
+move = stepper.move('cw', args.steps)
+time.sleep(0.5)
+move.cancel()
+print('cancelled after 0.5s: stopped after {} steps'.format(move.wait()))
@@ -0,0 +1,61 @@
+import os
+
+import cv2
+import numpy as np
+
+
+def plane_positions(center, planes, step, min_position, max_position):
+    """Returns the Z of each plane, centered on center unless that would leave the travel."""
+    first = max(min_position, min(center - (planes - 1) * step // 2, max_position - (planes - 1) * step))
+    positions = [min(max_position, max(min_position, first + index * step)) for index in range(planes)]
+    return sorted(set(positions))
+
+
+def capture_stack(positions, move_to, grab):
+    """Moves to every position and grabs one settled frame there. Returns the frames in the same order.
+
+    move_to(z) returns the time the stage settled at z and grab(after) a frame captured after that time.
+    """
+    frames = []
+    for position in positions:
+        frame = grab(move_to(position))
+        if frame is None:
+            raise IOError('No frame captured at position {}'.format(position))
+        frames.append(frame)
+    return frames
+
+
+def write_stack(directory, positions, frames):
+    """Writes each plane as z<position>.png in directory. Returns the file paths."""
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for position, frame in zip(positions, frames):
+        path = os.path.join(directory, 'z{:04d}.png'.format(position))
+        cv2.imwrite(path, frame)
+        paths.append(path)
+    return paths
+
+
+def fuse_stack(frames, blur=5):
+    """Returns one all-in-focus image, taking each pixel from the plane where it is sharpest.
+
+    Sharpness is the absolute Laplacian of each plane, smoothed over blur pixels so the choice of plane does
+    not flicker from one pixel to the next.
+    """
+    stack = np.stack(frames)
+    sharpness = np.empty(stack.shape[:3], dtype=np.float32)
+    for index, frame in enumerate(stack):
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+        laplacian = np.abs(cv2.Laplacian(gray, cv2.CV_32F))
+        sharpness[index] = cv2.GaussianBlur(laplacian, (0, 0), blur)
+    best = sharpness.argmax(axis=0)
+    if stack.ndim == 4:
+        best = best[..., None]
+    return np.take_along_axis(stack, best[None], axis=0)[0]
+
+
+def fuse_files(paths, output, blur=5):
+    """Fuses the planes stored at paths into output. Meant for a worker process, so only paths are pickled."""
+    fused = fuse_stack([cv2.imread(path) for path in paths], blur)
+    cv2.imwrite(output, fused)
+    return output